@@ -1,5 +1,6 @@
 
-#If admin wants to change his data, he can simply change in the following:
+#If admin wants to change his data, he can simply change in the following
+#(the password may be plain text or a hash printed by: python "Final code.py" --hash-password):
 admin_username="admin"
 admin_password="admin123"
 admin_firstname="Admin"
@@ -7,25 +8,817 @@ admin_lastname="User"
 admin_address="123 Admin St"
 
 
-#Importing modules ("abc" and "datetime")
+#Importing modules ("abc", "datetime", "json", "os", the helpers used by the account index, product catalog,
+#metrics and startup snapshot)
+import contextlib
+import functools
+import hashlib
+import hmac
+import importlib.util
+import io
+import json
+import mmap
+import os
+import pickle
+import re
+import secrets
+import struct
+import sys
+import threading
+import time
 from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
 from datetime import datetime
+from itertools import accumulate, islice
 
 
-#Represents the products in the store
+#Imports a module on first attribute access instead of now, so modules that only some menus need do not
+#slow down startup. Returns None when the module is not installed.
+def lazy_import(name):
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    spec.loader.exec_module(module)
+    return module
+
+#Only needed by the command line, the old text catalog, the network server, the account worker pool and the
+#password checks.
+argparse = lazy_import("argparse")
+ast = lazy_import("ast")
+asyncio = lazy_import("asyncio")
+concurrent_futures = lazy_import("concurrent.futures")
+multiprocessing = lazy_import("multiprocessing")
+
+#NumPy is optional; it is only needed for the sales analytics in the admin menu.
+np = lazy_import("numpy")
+
+
+#Timers and counters for the slow paths of the store (admin menu "Performance Report", METRICS on the server,
+#and a JSON dump in "metrics.json"). Nothing is measured until enable() is called: it wraps the methods listed
+#in TIMED with timers and restores the originals on disable(), so a disabled store runs the plain methods.
+#Byte and cache counters are only updated behind an "if metrics.enabled" check.
+#Latencies go into power-of-two histograms; the last RECENT operations are kept to show the slowest ones.
+#start_profiler() is the opt-in sampling profiler: a thread that records every thread's stack each "interval"
+#seconds, counted as collapsed stacks ("outer;inner;leaf") that flame graph tools can read.
+class Metrics:
+    TIMED = (
+        ("AccountManager", "load_accounts"), ("AccountManager", "save_accounts"), ("AccountManager", "save_products"),
+        ("AccountManager", "authenticate"), ("AccountManager", "register"), ("AccountStore", "compact"),
+        ("CheckoutPipeline", "process"), ("Customer", "checkout"),
+        ("ProductCatalog", "get"), ("ProductCatalog", "page"), ("ProductCatalog", "load_binary"),
+        ("ShoppingCart", "add_product"), ("ShoppingCart", "remove_product"), ("ShoppingCart", "calculate_total"),
+    )
+    RECENT = 1000
+    SLOWEST = 10
+    DUMP_FILENAME = "metrics.json"
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.caches = {}
+        self._originals = {}
+        self._profiler = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+            self.recent = deque(maxlen=self.RECENT)
+            self.stacks = {}
+            self.samples = 0
+
+    def enable(self):
+        if self.enabled:
+            return
+        for class_name, method in self.TIMED:
+            cls = globals()[class_name]
+            original = cls.__dict__[method]
+            self._originals[class_name, method] = original
+            setattr(cls, method, self._timed(f"{class_name}.{method}", original))
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        for (class_name, method), original in self._originals.items():
+            setattr(globals()[class_name], method, original)
+        self._originals.clear()
+        self.enabled = False
+
+    def _timed(self, name, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            began = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter_ns() - began)
+        return timed
+
+    def observe(self, name, elapsed):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = [0, 0, 0, [0] * 64]
+            timer[0] += 1
+            timer[1] += elapsed
+            timer[2] = max(timer[2], elapsed)
+            timer[3][elapsed.bit_length()] += 1
+            self.recent.append((elapsed, name, time.time()))
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Upper bound (ns) of the histogram bucket holding the given fraction of the calls.
+    @staticmethod
+    def _percentile(histogram, count, fraction):
+        seen = 0
+        for bucket, calls in enumerate(histogram):
+            seen += calls
+            if seen >= count * fraction:
+                return 1 << bucket
+        return 0
+
+    @property
+    def profiling(self):
+        return self._profiler is not None
+
+    @staticmethod
+    def _duration(us):
+        if us < 1:
+            return f"{us * 1000:.0f}ns"
+        return f"{us:.0f}us" if us < 1000 else f"{us / 1000:.1f}ms"
+
+    def start_profiler(self, interval=0.005):
+        if self._profiler is not None:
+            return
+        stop = threading.Event()
+        thread = threading.Thread(target=self._sample, args=(stop, interval), name="sampling-profiler", daemon=True)
+        self._profiler = (thread, stop, interval)
+        thread.start()
+
+    def stop_profiler(self):
+        if self._profiler is not None:
+            thread, stop, interval = self._profiler
+            stop.set()
+            thread.join()
+            self._profiler = None
+
+    def _sample(self, stop, interval):
+        me = threading.get_ident()
+        while not stop.wait(interval):
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                stacks.append(';'.join(reversed(stack)))
+            with self.lock:
+                self.samples += 1
+                for stack in stacks:
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            timers = {}
+            for name, (count, total, longest, histogram) in sorted(self.timers.items()):
+                timers[name] = {
+                    "calls": count, "total_ms": total / 1e6, "mean_us": total / count / 1e3, "max_us": longest / 1e3,
+                    "p50_us": self._percentile(histogram, count, 0.50) / 1e3, "p99_us": self._percentile(histogram, count, 0.99) / 1e3,
+                    "histogram_us": {str((1 << bucket) / 1e3): calls for bucket, calls in enumerate(histogram) if calls},
+                }
+            slowest = [{"operation": name, "ms": elapsed / 1e6, "at": datetime.fromtimestamp(at).strftime("%Y-%m-%d %H:%M:%S")}
+                       for elapsed, name, at in sorted(self.recent, reverse=True)[:self.SLOWEST]]
+            counters = dict(sorted(self.counters.items()))
+            stacks = dict(sorted(self.stacks.items(), key=lambda item: -item[1]))
+            samples = self.samples
+        caches = {}
+        for name, cache in self.caches.items():
+            lookups = cache.hits + cache.misses
+            caches[name] = {"hits": cache.hits, "misses": cache.misses, "hit_rate": cache.hits / lookups if lookups else None}
+        lookups = timers.get("ProductCatalog.get", {}).get("calls", 0)
+        if lookups:
+            hits = max(0, lookups - counters.get("products.loaded", 0))
+            caches["products"] = {"hits": hits, "misses": lookups - hits, "hit_rate": hits / lookups}
+        return {"enabled": self.enabled, "timers": timers, "counters": counters, "caches": caches, "slowest": slowest,
+                "profile": {"running": self.profiling, "samples": samples, "stacks": stacks}}
+
+    def dump(self, filename=None):
+        filename = filename or self.DUMP_FILENAME
+        with open(filename + ".tmp", 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(filename + ".tmp", filename)
+        return filename
+
+    def report(self):
+        snapshot = self.snapshot()
+        lines = [f"Metrics are {'on' if self.enabled else 'off'}; sampling profiler is {'running' if self.profiling else 'off'}."]
+        if snapshot["timers"]:
+            lines.append(f"{'Operation':<32}{'calls':>8}{'total ms':>11}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}{'max us':>10}")
+            for name, timer in snapshot["timers"].items():
+                lines.append(f"{name:<32}{timer['calls']:>8}{timer['total_ms']:>11.1f}{timer['mean_us']:>10.1f}"
+                             f"{timer['p50_us']:>10.1f}{timer['p99_us']:>10.1f}{timer['max_us']:>10.1f}")
+            lines.append("Latency histograms (calls per bucket, bucket = upper bound in us):")
+            for name, timer in snapshot["timers"].items():
+                buckets = "  ".join(f"<{self._duration(float(bound))}:{calls}" for bound, calls in timer["histogram_us"].items())
+                lines.append(f"  {name:<30}{buckets}")
+        saves = {"AccountStore.compact": "accounts.bytes_written", "AccountManager.save_products": "products.bytes_written"}
+        for timer_name, counter in saves.items():
+            calls = snapshot["timers"].get(timer_name, {}).get("calls")
+            if calls and counter in snapshot["counters"]:
+                lines.append(f"{counter}: {snapshot['counters'][counter] / calls:,.0f} bytes per save ({calls} saves)")
+        for name, value in snapshot["counters"].items():
+            lines.append(f"{name}: {value:,}")
+        for name, cache in snapshot["caches"].items():
+            if cache["hit_rate"] is not None:
+                lines.append(f"{name} cache: {cache['hits']} hits, {cache['misses']} misses, {cache['hit_rate']:.1%} hit rate")
+        if snapshot["slowest"]:
+            lines.append("Slowest recent operations:")
+            lines.extend(f"  {entry['ms']:>10.3f} ms  {entry['operation']:<32}{entry['at']}" for entry in snapshot["slowest"])
+        if snapshot["profile"]["samples"]:
+            lines.append(f"Hottest stacks ({snapshot['profile']['samples']} samples):")
+            for stack, count in islice(snapshot["profile"]["stacks"].items(), 5):
+                frames = stack.split(';')
+                callers = f"  <- {';'.join(frames[-4:-1])}" if len(frames) > 1 else ""
+                lines.append(f"  {count:>6}  {frames[-1]}{callers}")
+        return "\n".join(lines)
+
+metrics = Metrics()
+
+
+#Represents the products in the store. "stock" is the number of units left, or None for unlimited.
 class Product:
-    def __init__(self, id, name, price, description):
+    __slots__ = ('id', 'name', 'price', 'description', 'stock')
+
+    def __init__(self, id, name, price, description, stock=None):
         self.id = id
         self.name = name
         self.price = price
         self.description = description
+        self.stock = stock
 
     def __str__(self):
         return f"| {self.id:<3} | {self.name:<17} | {self.price:<10} | {self.description:<36} |"
 
 
+#Keeps the products behind a by-id hash index so add, remove and lookup are O(1).
+#Listing by name or price walks an id array kept in that order (searched by bisect with a key), built on
+#the first query and then kept sorted in place as products are added, removed or repriced. Keyword search uses an inverted index (word -> product ids, over names
+#and descriptions). Both are saved in the catalog file, so a loaded catalog pages and searches straight
+#from the mapping; products added since then are kept in an in-memory index and removed ones in "_dropped".
+#A catalog loaded from the binary file (product_data.bin) is memory-mapped: until a product is first
+#looked up, its index entry is just the position of its fixed-width record in the file.
+#File layout: header, then one record per product, then a heap holding the UTF-8 names and descriptions,
+#then the term section (term count, a sorted table of term entries, the term bytes and the id postings)
+#and the order section (product count, ids by price, ids by name).
+#Version 2 added the stock level to each record and version 3 the two index sections; older files are still read.
+#Lookups, searches and saves all take "lock": a save remaps the file and renumbers the unloaded records, and
+#server sessions read the catalog from several threads.
+class ProductCatalog:
+    FILE_MAGIC = b'PCAT'
+    FILE_VERSION = 3
+    FILE_PREFIX = struct.Struct('<4sI')             # magic, version
+    FILE_HEADERS = {
+        1: struct.Struct('<4sIQQ'),                 # magic, version, record count, heap offset
+        2: struct.Struct('<4sIQQ'),
+        3: struct.Struct('<4sIQQQQ'),               # ..., term section offset, order section offset
+    }
+    FILE_RECORDS = {
+        1: struct.Struct('<qdIIIIB3x'),             # id, price, name offset/length, description offset/length, flags
+        2: struct.Struct('<qdqIIIIB3x'),            # id, price, stock, name offset/length, description offset/length, flags
+        3: struct.Struct('<qdqIIIIB3x'),
+    }
+    COUNT = struct.Struct('<Q')
+    TERM_ENTRY = struct.Struct('<QQII')             # postings offset, term offset, term length, postings count (from section start)
+    PRICE_IS_INT = 1
+    UNLIMITED_STOCK = -1
+    SWAP = sys.byteorder != 'little'
+    WORD = re.compile(r'\w+')
+    SORTS = ("price", "-price", "name")
+    SORT_MATCHES = 2000                             # keyword matches up to this many are sorted directly
+
+    def __init__(self, products=()):
+        self.lock = threading.RLock()
+        self._by_id = {}
+        self._by_name = None
+        self._by_price = None
+        self._terms = None
+        self._dropped = set()
+        self._map = None
+        self._start = 0
+        self._heap = 0
+        self._term_section = 0
+        self._term_count = 0
+        self._order_section = 0
+        self._record = None
+        self.pricing = PricingEngine(self)
+        self.extend(products)
+
+    def __iter__(self):
+        with self.lock:
+            ids = list(self._by_id)
+        for product_id in ids:
+            product = self.get(product_id)
+            if product is not None:
+                yield product
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, product_id):
+        with self.lock:
+            return product_id in self._by_id
+
+    def get(self, product_id):
+        with self.lock:
+            product = self._by_id.get(product_id)
+            if type(product) is int:
+                product = self._materialize(product_id, product)
+            return product
+
+    def add(self, product):
+        with self.lock:
+            if product.id in self._by_id:
+                raise ShoppingCartException(f"Already a product exists with id: {product.id}")
+            self._by_id[product.id] = product
+            if self._terms is not None:
+                self._index_terms(product.id, product.name, product.description)
+            self._index_order(product.id)
+            self.pricing.product_changed(product)
+
+    def extend(self, products):
+        for product in products:
+            self.add(product)
+
+    def remove(self, product_id):
+        with self.lock:
+            product = self.get(product_id)
+            if product is not None:
+                self._unindex_order(product_id)
+                del self._by_id[product_id]
+                if self._terms is not None:
+                    for term in self._tokens(product.name + ' ' + product.description):
+                        postings = self._terms.get(term)
+                        if postings is not None and product_id in postings:
+                            postings.remove(product_id)
+                    if self._term_count:
+                        self._dropped.add(product_id)
+                self.pricing.product_changed(product, removed=True)
+            return product
+
+    # Price changes go through here so the price index and the memoized cart totals follow.
+    def set_price(self, product_id, price):
+        with self.lock:
+            product = self.get(product_id)
+            if product is None:
+                raise ShoppingCartException(f"Product does not exist with id: {product_id}")
+            self._unindex_order(product_id, price_only=True)
+            self.pricing.reprice(product, price)
+            self._index_order(product_id, price_only=True)
+            return product
+
+    def _invalidate(self):
+        self._by_name = None
+        self._by_price = None
+        self._order_section = 0
+
+    # Price, name and description of a product, read from its record if it has not been looked up yet.
+    def _fields(self, product_id):
+        product = self._by_id[product_id]
+        if type(product) is int:
+            price, stock, flags, name, description = self._read_record(product)
+            return price, str(name, 'utf-8'), str(description, 'utf-8')
+        return product.price, product.name, product.description
+
+    def _price(self, product_id):
+        product = self._by_id[product_id]
+        if type(product) is int:
+            return self._record.unpack_from(self._map, self._start + product * self._record.size)[1]
+        return product.price
+
+    def _name_key(self, product_id):
+        return self._fields(product_id)[1].lower()
+
+    def _price_order(self, product_id):
+        return self._price(product_id), product_id
+
+    def _name_order(self, product_id):
+        return self._name_key(product_id), product_id
+
+    # The order indexes built so far, for a product being added, removed or repriced. A change makes the
+    # file's saved order stale, so the saved indexes are read in first and then kept up to date in memory.
+    def _order_indexes(self, price_only):
+        if self._order_section:
+            self._price_index()
+            self._name_index()
+            self._order_section = 0
+        indexes = [(self._by_price, self._price_order)]
+        if not price_only:
+            indexes.append((self._by_name, self._name_order))
+        return [(index, key) for index, key in indexes if index is not None]
+
+    # Adding or removing one product moves only its own entry in each order index (a bisect, not a sort).
+    def _index_order(self, product_id, price_only=False):
+        for index, key in self._order_indexes(price_only):
+            index.insert(bisect_left(index, key(product_id), key=key), product_id)
+
+    def _unindex_order(self, product_id, price_only=False):
+        for index, key in self._order_indexes(price_only):
+            del index[bisect_left(index, key(product_id), key=key)]
+
+    def _name_index(self):
+        if self._by_name is None:
+            if self._order_section:
+                count = self.COUNT.unpack_from(self._map, self._order_section)[0]
+                self._by_name = self._saved_ids(self._order_section + self.COUNT.size + 8 * count, count)
+            else:
+                self._by_name = array('q', sorted(self._by_id, key=self._name_order))
+        return self._by_name
+
+    def _price_index(self):
+        if self._by_price is None:
+            if self._order_section:
+                self._by_price = self._saved_ids(self._order_section + self.COUNT.size, self.COUNT.unpack_from(self._map, self._order_section)[0])
+            else:
+                self._by_price = array('q', sorted(self._by_id, key=self._price_order))
+        return self._by_price
+
+    def search_prefix(self, prefix):
+        with self.lock:
+            by_name = self._name_index()
+            prefix = prefix.lower()
+            results = []
+            for i in range(bisect_left(by_name, prefix, key=self._name_key), len(by_name)):
+                if not self._name_key(by_name[i]).startswith(prefix):
+                    break
+                results.append(self.get(by_name[i]))
+            return results
+
+    def price_range(self, low, high):
+        with self.lock:
+            by_price = self._price_index()
+            start = bisect_left(by_price, low, key=self._price)
+            end = bisect_right(by_price, high, key=self._price)
+            return [self.get(product_id) for product_id in by_price[start:end]]
+
+    def _tokens(self, text):
+        return set(self.WORD.findall(text.lower()))
+
+    def _has_terms(self, product_id, terms):
+        price, name, description = self._fields(product_id)
+        return terms <= self._tokens(name + ' ' + description)
+
+    def _index_terms(self, product_id, name, description):
+        for term in self._tokens(name + ' ' + description):
+            postings = self._terms.get(term)
+            if postings is None:
+                postings = self._terms[term] = array('q')
+            postings.append(product_id)
+
+    # Without a saved term section every product goes into the in-memory index, on the first search.
+    def _build_terms(self):
+        self._terms = {}
+        for product_id in self._by_id:
+            price, name, description = self._fields(product_id)
+            self._index_terms(product_id, name, description)
+
+    def _saved_ids(self, start, count):
+        ids = array('q')
+        ids.frombytes(self._map[start:start + 8 * count])
+        if self.SWAP:
+            ids.byteswap()
+        return ids
+
+    def _id_bytes(self, ids):
+        ids = array('q', ids)
+        if self.SWAP:
+            ids.byteswap()
+        return ids.tobytes()
+
+    # Term bytes, postings start and postings length of entry "i" of the saved term table.
+    def _saved_term(self, i):
+        section = self._term_section
+        postings, offset, length, count = self.TERM_ENTRY.unpack_from(self._map, section + self.COUNT.size + i * self.TERM_ENTRY.size)
+        return self._map[section + offset:section + offset + length], section + postings, count
+
+    # Binary search of the saved term table; returns the saved postings of "term", or None.
+    def _saved_postings(self, term):
+        key = term.encode('utf-8')
+        lo, hi = 0, self._term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found, start, count = self._saved_term(mid)
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return self._saved_ids(start, count)
+        return None
+
+    def _postings(self, term):
+        if self._terms is None:
+            self._build_terms()
+        ids = self._saved_postings(term) if self._term_count else None
+        if ids is None:
+            ids = []
+        elif self._dropped:
+            ids = [product_id for product_id in ids if product_id not in self._dropped]
+        added = self._terms.get(term)
+        if added:
+            ids = list(ids) + list(added)
+        return ids
+
+    # Ids in name or price order ("price", "-price", "name"; catalog order otherwise, or price order when
+    # only a price range is given), walked lazily from the order indexes.
+    def _ordered_ids(self, low, high, sort):
+        filtered = low is not None or high is not None
+        low = float('-inf') if low is None else low
+        high = float('inf') if high is None else high
+        if sort == "name":
+            ids = iter(self._name_index())
+            return (product_id for product_id in ids if low <= self._price(product_id) <= high) if filtered else ids
+        if filtered or sort in ("price", "-price"):
+            by_price = self._price_index()
+            start = bisect_left(by_price, low, key=self._price)
+            end = bisect_right(by_price, high, key=self._price)
+            positions = range(end - 1, start - 1, -1) if sort == "-price" else range(start, end)
+            return (by_price[i] for i in positions)
+        return iter(self._by_id)
+
+    # Ids matching a search, in the requested order. Keyword candidates come from the shortest postings
+    # list and are checked against the other keywords one by one, so the first page of a search is found
+    # without evaluating all of it; sorted searches with many matches walk the order indexes instead.
+    def _search_ids(self, keywords=(), low=None, high=None, sort=None):
+        terms = self._tokens(' '.join(keywords))
+        if not terms:
+            return self._ordered_ids(low, high, sort)
+        candidates = min((self._postings(term) for term in terms), key=len)
+        if len(terms) > 1:
+            matches = lambda product_id: self._has_terms(product_id, terms)
+        else:
+            matches = lambda product_id: True
+        in_range = lambda product_id: (low is None or self._price(product_id) >= low) and (high is None or self._price(product_id) <= high)
+        if sort is None:
+            return (product_id for product_id in candidates if in_range(product_id) and matches(product_id))
+        if len(candidates) <= self.SORT_MATCHES:
+            ids = [product_id for product_id in candidates if in_range(product_id) and matches(product_id)]
+            if sort == "name":
+                ids.sort(key=lambda product_id: (self._name_key(product_id), product_id))
+            else:
+                ids.sort(key=lambda product_id: (self._price(product_id), product_id), reverse=sort == "-price")
+            return ids
+        candidates = set(candidates)
+        return (product_id for product_id in self._ordered_ids(low, high, sort) if product_id in candidates and matches(product_id))
+
+    def search(self, keywords=(), low=None, high=None, sort=None):
+        with self.lock:
+            return [self.get(product_id) for product_id in self._search_ids(keywords, low, high, sort)]
+
+    # One page (numbered from 1) of a search, and whether there are more after it. Only the products
+    # on the page are loaded.
+    def page(self, number, size=20, keywords=(), low=None, high=None, sort=None):
+        with self.lock:
+            ids = self._search_ids(keywords, low, high, sort)
+            start = (number - 1) * size
+            window = ids[start:start + size + 1] if isinstance(ids, list) else list(islice(ids, start, start + size + 1))
+            return [self.get(product_id) for product_id in window[:size]], len(window) > size
+
+    def _read_record(self, position):
+        fields = self._record.unpack_from(self._map, self._start + position * self._record.size)
+        if len(fields) == 7:
+            _, price, name_offset, name_length, description_offset, description_length, flags = fields
+            stock = self.UNLIMITED_STOCK
+        else:
+            _, price, stock, name_offset, name_length, description_offset, description_length, flags = fields
+        name_offset += self._heap
+        description_offset += self._heap
+        return price, stock, flags, self._map[name_offset:name_offset + name_length], self._map[description_offset:description_offset + description_length]
+
+    def _materialize(self, product_id, position):
+        price, stock, flags, name, description = self._read_record(position)
+        product = Product(product_id, name.decode('utf-8'), int(price) if flags & self.PRICE_IS_INT else price, description.decode('utf-8'),
+                          None if stock == self.UNLIMITED_STOCK else stock)
+        self._by_id[product_id] = product
+        if metrics.enabled:
+            metrics.add("products.loaded")
+        return product
+
+    def _map_file(self, filename):
+        with open(filename, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = self.FILE_PREFIX.unpack_from(mapped)
+        if magic != self.FILE_MAGIC or version not in self.FILE_RECORDS:
+            mapped.close()
+            raise ValueError(f"{filename} is not a product catalog this version can read")
+        header = self.FILE_HEADERS[version].unpack_from(mapped)
+        count, self._heap = header[2:4]
+        self._term_section, self._order_section = header[4:6] if version >= 3 else (0, 0)
+        self._term_count = self.COUNT.unpack_from(mapped, self._term_section)[0] if self._term_section else 0
+        self._map = mapped
+        self._start = self.FILE_HEADERS[version].size
+        self._record = self.FILE_RECORDS[version]
+        return count
+
+    # "state" is the index from snapshot_state() for this same file (see StartupSnapshot); it replaces
+    # the scan of every record.
+    def load_binary(self, filename, state=None):
+        with self.lock:
+            self.close()
+            self._invalidate()
+            count = self._map_file(filename)
+            if state is not None:
+                self._by_id = state
+            else:
+                ids_only = struct.Struct(f'<q{self._record.size - 8}x')
+                with memoryview(self._map) as view:
+                    records = view[self._start:self._start + count * self._record.size]
+                    ids = [product_id for product_id, in ids_only.iter_unpack(records)]
+                    records.release()
+                for position, product_id in enumerate(ids):
+                    self._by_id.setdefault(product_id, position)
+            if len(self._by_id) != count:
+                self._order_section = 0
+            # With a saved term section, only products added from now on go into the in-memory index.
+            self._terms = {} if self._term_count else None
+            self._dropped = set()
+
+    # The term section for the current products: copied as-is when nothing was added or removed since
+    # the catalog was loaded, otherwise the saved postings merged with the in-memory ones.
+    def _term_bytes(self):
+        if self._term_count and not self._dropped and not any(self._terms.values()):
+            key, start, count = self._saved_term(self._term_count - 1)
+            return self._map[self._term_section:start + 8 * count]
+        if self._terms is None:
+            self._build_terms()
+        terms = {}
+        for i in range(self._term_count):
+            key, start, count = self._saved_term(i)
+            ids = self._saved_ids(start, count)
+            if self._dropped:
+                ids = [product_id for product_id in ids if product_id not in self._dropped]
+            if ids:
+                terms[key] = ids
+        for term, postings in self._terms.items():
+            if postings:
+                key = term.encode('utf-8')
+                terms[key] = list(terms.get(key, ())) + list(postings)
+        keys = sorted(terms)
+        table = self.COUNT.size + len(keys) * self.TERM_ENTRY.size
+        entries = [self.COUNT.pack(len(keys))]
+        names = bytearray()
+        postings_offset = table + sum(len(key) for key in keys)
+        postings = []
+        for key in keys:
+            ids = terms[key]
+            entries.append(self.TERM_ENTRY.pack(postings_offset, table + len(names), len(key), len(ids)))
+            names += key
+            postings.append(self._id_bytes(ids))
+            postings_offset += 8 * len(ids)
+        return b''.join(entries) + names + b''.join(postings)
+
+    def _order_bytes(self):
+        return self.COUNT.pack(len(self._by_id)) + self._id_bytes(self._price_index()) + self._id_bytes(self._name_index())
+
+    # Products that were never looked up are copied record-for-record from the old mapping.
+    def save_binary(self, filename):
+        with self.lock:
+            header = self.FILE_HEADERS[self.FILE_VERSION]
+            record = self.FILE_RECORDS[self.FILE_VERSION]
+            records = []
+            heap = bytearray()
+            unloaded = {}
+            for position, (product_id, product) in enumerate(self._by_id.items()):
+                if type(product) is int:
+                    price, stock, flags, name, description = self._read_record(product)
+                    unloaded[product_id] = position
+                else:
+                    price, flags = float(product.price), self.PRICE_IS_INT if isinstance(product.price, int) else 0
+                    stock = self.UNLIMITED_STOCK if product.stock is None else product.stock
+                    name, description = product.name.encode('utf-8'), product.description.encode('utf-8')
+                records.append(record.pack(product_id, price, stock, len(heap), len(name), len(heap) + len(name), len(description), flags))
+                heap += name
+                heap += description
+            terms = self._term_bytes()
+            orders = self._order_bytes()
+            temp_filename = filename + ".tmp"
+            with open(temp_filename, 'wb') as f:
+                heap_offset = header.size + len(records) * record.size
+                term_offset = heap_offset + len(heap)
+                f.write(header.pack(self.FILE_MAGIC, self.FILE_VERSION, len(records), heap_offset, term_offset, term_offset + len(terms)))
+                f.write(b''.join(records))
+                f.write(heap)
+                f.write(terms)
+                f.write(orders)
+                f.flush()
+                os.fsync(f.fileno())
+                if metrics.enabled:
+                    metrics.add("products.bytes_written", f.tell())
+            # The new file is mapped before the old mapping goes, so a failure leaves the catalog as it was.
+            os.replace(temp_filename, filename)
+            old_map = self._map
+            self._map_file(filename)
+            if old_map is not None:
+                old_map.close()
+            self._by_id.update(unloaded)
+            self._terms = {}
+            self._dropped = set()
+
+    # The by-id index (record positions, and the products looked up so far) for a startup snapshot, or None
+    # when products were added or removed since the last save (that drops the saved order section).
+    def snapshot_state(self):
+        if self._map is None or not self._order_section:
+            return None
+        return self._by_id
+
+    def close(self):
+        with self.lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+                self._term_count = 0
+                self._order_section = 0
+
+
+#A catalog search as typed in the menus and the server's PRODUCTS command: keywords plus optional
+#"price:<low>-<high>" (either bound may be left out) and "sort:price", "sort:-price" or "sort:name".
+class ProductQuery:
+    __slots__ = ('keywords', 'low', 'high', 'sort')
+    PAGE_SIZE = 20
+
+    def __init__(self, keywords=(), low=None, high=None, sort=None):
+        self.keywords = tuple(keywords)
+        self.low = low
+        self.high = high
+        self.sort = sort
+
+    @classmethod
+    def parse(cls, text):
+        query = cls()
+        keywords = []
+        for word in text.split():
+            if word.lower().startswith("price:"):
+                low, _, high = word[6:].partition("-")
+                try:
+                    query.low = float(low) if low else None
+                    query.high = float(high) if high else None
+                except ValueError:
+                    raise ValueError(f"Invalid price range: {word[6:]} (use price:100-500)")
+            elif word.lower().startswith("sort:"):
+                if word[5:].lower() not in ProductCatalog.SORTS:
+                    raise ValueError(f"Invalid sort: {word[5:]} (use {', '.join('sort:' + sort for sort in ProductCatalog.SORTS)})")
+                query.sort = word[5:].lower()
+            else:
+                keywords.append(word)
+        query.keywords = tuple(keywords)
+        return query
+
+    def __str__(self):
+        words = list(self.keywords)
+        if self.low is not None or self.high is not None:
+            words.append(f"price:{'' if self.low is None else f'{self.low:g}'}-{'' if self.high is None else f'{self.high:g}'}")
+        if self.sort:
+            words.append("sort:" + self.sort)
+        return ' '.join(words)
+
+#Renders one page of the catalog (or of a search) as a single block of text, so a page is written with one
+#print however large the catalog is. Returns the text and whether there is a next page.
+def render_product_page(products, page=1, query=None, page_size=ProductQuery.PAGE_SIZE):
+    query = query or ProductQuery()
+    found, more = products.page(page, page_size, query.keywords, query.low, query.high, query.sort)
+    lines = ["-------------------------------------------------------------------------------",
+             "| ID. |    Product Name   | Price (Rs) |              Description             |",
+             "-------------------------------------------------------------------------------"]
+    lines.extend(str(product) for product in found)
+    lines.append("-------------------------------------------------------------------------------")
+    search = f" for '{query}'" if str(query) else ""
+    if found:
+        first = (page - 1) * page_size + 1
+        lines.append(f"Page {page}: products {first}-{first + len(found) - 1}{search}{' (more on the next page)' if more else ''}")
+    else:
+        lines.append(f"No products{search} on page {page}.")
+    return '\n'.join(lines), more
+
 #An abstract base class for users, requiring the implementation of view_products.
 class User(ABC):
+    __slots__ = ('username', 'password', 'first_name', 'last_name', 'address')
+
     def __init__(self, username, password, first_name, last_name, address):
         self.username = username
         self.password = password
@@ -34,29 +827,47 @@ class User(ABC):
         self.address = address
 
     @abstractmethod
-    def view_products(self, products):
+    def view_products(self, products, page=1, query=None):
         pass
 
 # Inherits from User, allowing customers to manage their shopping cart and view purchase history
+# "lock" is held while the cart or history changes and while the account is encoded, so a save running in
+# another thread never sees a half-made change. Code holding it must not wait for the account store's lock.
 class Customer(User):
+    __slots__ = ('cart', 'history', 'lock')
+    STATE = User.__slots__ + ('cart', 'history')
+
     def __init__(self, username, password, first_name, last_name, address, cart=None, history=None):
         super().__init__(username, password, first_name, last_name, address)
         self.cart = cart if cart else ShoppingCart()
-        self.history = history if history else []
+        self.history = history if history is not None else PurchaseHistory(self.cart.catalog)
+        self.lock = threading.RLock()
 
-    def view_products(self, products):
-        print("-------------------------------------------------------------------------------")
-        print("| ID. |    Product Name   | Price (Rs) |              Description             |")
-        print("-------------------------------------------------------------------------------")
-        for product in products:
-            print(product)
-        print("-------------------------------------------------------------------------------")
+    # Locks can't be pickled (startup snapshot, worker pipes), so a fresh one is made on load.
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.STATE}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.lock = threading.RLock()
+
+    def view_products(self, products, page=1, query=None):
+        text, more = render_product_page(products, page, query)
+        print(text)
+        return more
 
     def add_to_cart(self, product, quantity=1):
-        self.cart.add_product(product, quantity)
+        with self.lock:
+            self.cart.add_product(product, quantity)
 
     def remove_from_cart(self, product, quantity=1):
-        self.cart.remove_product(product, quantity)
+        with self.lock:
+            self.cart.remove_product(product, quantity)
+
+    def apply_coupon(self, code):
+        with self.lock:
+            return self.cart.apply_coupon(code)
 
     def view_cart(self):
         self.cart.view_cart()
@@ -65,176 +876,1752 @@ class Customer(User):
         if not self.cart.items:
             print("Your cart is empty! Can't checkout.")
         else:
-            total_price = self.cart.calculate_total()
-            purchase_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            self.history.append({"date": purchase_date, "items": self.cart.items.copy(), "total": total_price})
+            record = self.place_order()
+            print(f"Checked out successfully.\nYour Total Bill: Rs.{record.total}")
+            return record
+
+    # Moves the cart into the purchase history and returns the new order, without printing anything.
+    def place_order(self):
+        record = self.prepare_order()
+        self.commit_order(record)
+        return record
+
+    # The order the cart would become, without changing the customer.
+    def prepare_order(self):
+        with self.lock:
+            return self._prepare_order()
+
+    def _prepare_order(self):
+        total_price = self.cart.calculate_total()
+        purchase_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        lines = self.cart.items.values()
+        catalog = self.cart.catalog if self.cart.catalog is not None else ProductCatalog(line.product for line in lines)
+        return OrderRecord(purchase_date, self.cart.items.keys(), [line.quantity for line in lines], total_price, catalog)
+
+    def commit_order(self, record):
+        with self.lock:
+            self.history.append(record)
             self.cart.clear_cart()
-            print(f"Checked out successfully.\nYour Total Bill: Rs.{total_price}")
 
-    def view_history(self):
+    # Prints one page of orders, newest first, and returns the cursor of the next (older) page or None.
+    def view_history(self, cursor=None, limit=10, start=None, end=None):
         if not self.history:
             print("\"You have no Shopping History!\"\n It will be available after checking out.")
+            return None
+        records, next_cursor = self.history.page(cursor, limit, start, end)
+        lines = [f"{len(self.history)} orders, Rs.{round(self.history.spent, 2)} spent in total."]
+        if start or end:
+            lines.append(f"Orders from {start or 'the first'} to {end or 'the last'}: Rs.{round(self.history.spent_between(start, end), 2)}")
+        if not records:
+            lines.append("No orders in this range.")
+        for record in records:
+            lines.append(f"Date: {record.date}")
+            for product_id, product, quantity in record.lines():
+                if product is None:
+                    lines.append(f"  Product #{product_id} (no longer in store) x {quantity}")
+                else:
+                    lines.append(f"  {product.name}: Rs.{product.price} each x {quantity}")
+            lines.append(f"Total: Rs.{record.total}")
+            lines.append("------------------------------------------")
+        print('\n'.join(lines))
+        return next_cursor
+
+#One line of a shopping cart.
+class CartLine:
+    __slots__ = ('product', 'quantity')
+
+    def __init__(self, product, quantity):
+        self.product = product
+        self.quantity = quantity
+
+#One checked-out order. Product ids and quantities are kept in typed arrays and the products are
+#looked up by id in the shared catalog, so an order costs a few bytes per line instead of a dict each.
+class OrderRecord:
+    __slots__ = ('date', 'product_ids', 'quantities', 'total', 'catalog')
+
+    def __init__(self, date, product_ids, quantities, total, catalog):
+        self.date = date
+        self.product_ids = array('q', product_ids)
+        self.quantities = array('q', quantities)
+        self.total = total
+        self.catalog = catalog
+
+    def lines(self):
+        for product_id, quantity in zip(self.product_ids, self.quantities):
+            yield product_id, self.catalog.get(product_id), quantity
+
+#A customer's orders, oldest first, kept as columns: one date and total per order, the start of each
+#order's lines in "offsets", and flat product id / quantity arrays. OrderRecords are only built for the
+#orders that are read. Dates sort as text, so date ranges are found by bisect, and "spent" is the
+#running lifetime total, so summaries never walk the orders.
+#An empty history shares the read-only EMPTY columns until its first order, so a user without orders stays small.
+class PurchaseHistory:
+    __slots__ = ('catalog', 'dates', 'totals', 'offsets', 'product_ids', 'quantities', 'spent')
+    EMPTY = ((), array('d'), array('q', [0]), array('q'), array('q'))
+
+    def __init__(self, catalog=None, records=()):
+        self.catalog = catalog
+        self.dates, self.totals, self.offsets, self.product_ids, self.quantities = self.EMPTY
+        self.spent = 0.0
+        for record in records:
+            self.append(record)
+
+    @classmethod
+    def from_columns(cls, catalog, dates, totals, counts, product_ids, quantities, spent=None):
+        history = cls(catalog)
+        history.dates = dates
+        history.totals = totals
+        history.offsets = array('q', accumulate(counts, initial=0))
+        history.product_ids = product_ids if product_ids.typecode == 'q' else array('q', product_ids)
+        history.quantities = quantities if quantities.typecode == 'q' else array('q', quantities)
+        history.spent = sum(totals) if spent is None else spent
+        return history
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.dates)
+        if not 0 <= index < len(self.dates):
+            raise IndexError("order index out of range")
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return OrderRecord(self.dates[index], self.product_ids[start:end], self.quantities[start:end], self.totals[index], self.catalog)
+
+    def __iter__(self):
+        for index in range(len(self.dates)):
+            yield self[index]
+
+    def __reversed__(self):
+        for index in range(len(self.dates) - 1, -1, -1):
+            yield self[index]
+
+    def append(self, record):
+        if self.catalog is None:
+            self.catalog = record.catalog
+        if not self.dates:
+            self.dates, self.totals, self.offsets, self.product_ids, self.quantities = [], array('d'), array('q', [0]), array('q'), array('q')
+        self.dates.append(record.date)
+        self.totals.append(record.total)
+        self.product_ids.extend(record.product_ids)
+        self.quantities.extend(record.quantities)
+        self.offsets.append(len(self.product_ids))
+        self.spent += record.total
+
+    def pop(self):
+        record = self[-1]
+        start = self.offsets[-2]
+        del self.dates[-1], self.totals[-1], self.offsets[-1]
+        del self.product_ids[start:], self.quantities[start:]
+        self.spent -= record.total
+        return record
+
+    # Positions of the orders dated from "start" to "end" inclusive; either may be a prefix such as "2024-07".
+    def _span(self, start=None, end=None):
+        low = bisect_left(self.dates, start) if start else 0
+        high = bisect_right(self.dates, end + '\x7f') if end else len(self.dates)
+        return low, max(low, high)
+
+    def last(self, count):
+        return [self[index] for index in range(len(self.dates) - 1, max(len(self.dates) - count, 0) - 1, -1)]
+
+    def between(self, start=None, end=None):
+        low, high = self._span(start, end)
+        return [self[index] for index in range(low, high)]
+
+    def spent_between(self, start=None, end=None):
+        low, high = self._span(start, end)
+        return sum(self.totals[low:high])
+
+    # Newest-first pages of at most "limit" orders (optionally within a date range). "cursor" is the value
+    # returned with the previous page; None is returned once there are no older orders.
+    def page(self, cursor=None, limit=10, start=None, end=None):
+        low, high = self._span(start, end)
+        top = high if cursor is None else max(low, min(cursor, high))
+        bottom = max(low, top - limit)
+        return [self[index] for index in range(top - 1, bottom - 1, -1)], bottom if bottom > low else None
+
+#Prices carts from the promotion rules kept in pricing_rules.json. A rule is a dict, one of:
+#  {"type": "percent", "percent": 10, "products": [1, 2]}      percentage off those products ("products" left out: all of them)
+#  {"type": "category", "category": "audio", "percent": 15}     percentage off every product of a category
+#  {"type": "buy_x_get_y", "product": 3, "buy": 2, "get": 1}    for every 2 units bought the next 1 is free
+#  {"type": "coupon", "code": "SAVE10", "percent": 10}          a code taking 10% (and/or "amount" rupees) off the cart total,
+#                                                               optionally only from "min_total"
+#A category is {"ids": [...]} and/or {"keywords": [...]}; keyword categories are matched against the catalog when
+#the rules are compiled, and again whenever a product is added or removed. Where several percentages apply to a product the largest wins, and buy-x-get-y applies on top.
+#compile() folds the rules into one (factor, buy, get) entry per discounted product, so pricing a cart line is a
+#single dict lookup ("plain" means no product offers at all). Each rule or price change bumps "version" and stamps only the products whose price it
+#changed ("everything" for changes to the all-products discount), which is what tells a cart whether its
+#memoized total is still good.
+class PricingEngine:
+    RULE_TYPES = ("percent", "category", "buy_x_get_y", "coupon")
+    NO_DISCOUNT = (1, 0, 0)
+
+    def __init__(self, catalog=None):
+        self.catalog = catalog
+        self.rules = []
+        self.categories = {}
+        self.lines = {}
+        self.default = self.NO_DISCOUNT
+        self.coupons = {}
+        self.plain = True
+        self.version = 0
+        self.everything = 0
+        self.stamps = {}
+        self._sources = ({}, {}, 0, [])
+
+    # Replaces the rule set. Invalid rules raise ValueError and leave the current rules in place.
+    def set_rules(self, rules, categories=None):
+        categories = dict(categories or {})
+        lines, default, coupons, sources = self.compile(rules, categories)
+        self.version += 1
+        if default != self.default:
+            self.everything = self.version
+        for product_id in self.lines.keys() | lines.keys():
+            if self.lines.get(product_id, self.default) != lines.get(product_id, default):
+                self.stamps[product_id] = self.version
+        self.rules, self.categories = list(rules), categories
+        self.lines, self.default, self.coupons, self._sources = lines, default, coupons, sources
+        self.plain = not lines and default == self.NO_DISCOUNT
+
+    # Returns the compiled entries, the all-products default, the coupons and what the entries came from:
+    # percentages by explicit product id, buy-x-get-y offers, the all-products percentage and the keyword
+    # category rules as (term sets, percent). Those let product_changed() price one product on its own.
+    def compile(self, rules, categories):
+        explicit, offers, coupons = {}, {}, {}
+        keyword_rules = []
+        everything = 0
+        for name, category in categories.items():
+            if not isinstance(category, dict) or not category.keys() <= {"ids", "keywords"}:
+                raise ValueError(f'Invalid category {name!r}: expected {{"ids": [...], "keywords": [...]}}')
+        for rule in rules:
+            try:
+                kind = rule["type"]
+                if kind == "percent":
+                    if rule.get("products") is None:
+                        everything = max(everything, self._percent(rule))
+                    else:
+                        for product_id in rule["products"]:
+                            explicit[int(product_id)] = max(explicit.get(int(product_id), 0), self._percent(rule))
+                elif kind == "category":
+                    percent = self._percent(rule)
+                    if rule["category"] not in categories:
+                        raise ValueError(f"unknown category {rule['category']!r}")
+                    category = categories[rule["category"]]
+                    for product_id in category.get("ids", ()):
+                        explicit[int(product_id)] = max(explicit.get(int(product_id), 0), percent)
+                    if category.get("keywords"):
+                        keyword_rules.append(([self._terms(keyword) for keyword in category["keywords"]], percent))
+                elif kind == "buy_x_get_y":
+                    buy, get = int(rule["buy"]), int(rule["get"])
+                    if buy < 1 or get < 1:
+                        raise ValueError("buy and get must be at least 1")
+                    offers[int(rule["product"])] = (buy, get)
+                elif kind == "coupon":
+                    amount, minimum = float(rule.get("amount", 0)), float(rule.get("min_total", 0))
+                    if amount < 0 or minimum < 0:
+                        raise ValueError("amount and min_total can't be negative")
+                    coupons[str(rule["code"]).strip().upper()] = (1 - self._percent(rule, 0) / 100, amount, minimum)
+                else:
+                    raise ValueError(f"unknown type {kind!r}, expected one of {', '.join(self.RULE_TYPES)}")
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                raise ValueError(f"Invalid pricing rule {rule}: {e}")
+        percents = dict(explicit)
+        if self.catalog is not None:
+            with self.catalog.lock:
+                for term_sets, percent in keyword_rules:
+                    for terms in term_sets:
+                        for product_id in self.catalog._search_ids(terms):
+                            percents[product_id] = max(percents.get(product_id, 0), percent)
+        lines = {product_id: self._line(max(percents.get(product_id, 0), everything), offers.get(product_id))
+                 for product_id in percents.keys() | offers.keys()}
+        return lines, self._line(everything, None), coupons, (explicit, offers, everything, keyword_rules)
+
+    @staticmethod
+    def _line(percent, offer):
+        buy, get = offer or (0, 0)
+        return (1 - percent / 100 if percent else 1, buy, get)
+
+    @staticmethod
+    def _terms(keyword):
+        terms = frozenset(ProductCatalog.WORD.findall(str(keyword).lower()))
+        if not terms:
+            raise ValueError(f"keyword {keyword!r} has no words")
+        return terms
+
+    @staticmethod
+    def _percent(rule, default=None):
+        percent = float(rule["percent"] if default is None else rule.get("percent", default))
+        if not 0 <= percent <= 100:
+            raise ValueError("percent must be between 0 and 100")
+        return percent
+
+    def line_total(self, product, quantity):
+        factor, buy, get = self.lines.get(product.id, self.default)
+        if buy:
+            quantity -= quantity // (buy + get) * get
+        if factor == 1:
+            return product.price * quantity
+        return round(product.price * quantity * factor, 2)
+
+    def apply_coupon(self, subtotal, code):
+        coupon = self.coupons.get(code) if code else None
+        if coupon is None or subtotal < coupon[2]:
+            return subtotal
+        factor, amount = coupon[0], coupon[1]
+        return max(0, round(subtotal * factor - amount, 2))
+
+    # Called by the catalog when a product is added or removed: only that product is matched against the
+    # keyword categories, and only its own entry (and stamp) changes, if its price changes at all.
+    def product_changed(self, product, removed=False):
+        explicit, offers, everything, keyword_rules = self._sources
+        if not keyword_rules:
+            return
+        percent = max(explicit.get(product.id, 0), everything)
+        if not removed:
+            words = frozenset(ProductCatalog.WORD.findall((product.name + ' ' + product.description).lower()))
+            for term_sets, rule_percent in keyword_rules:
+                if rule_percent > percent and any(terms <= words for terms in term_sets):
+                    percent = rule_percent
+        line = self._line(percent, offers.get(product.id))
+        if line == self.lines.get(product.id, self.default):
+            return
+        if line == self.default:
+            self.lines.pop(product.id, None)
         else:
-            for record in self.history:
-                print(f"Date: {record['date']}")
-                for item in record['items']:
-                    print(f"  {record['items'][item]['product'].name}: Rs.{record['items'][item]['product'].price} each x {record['items'][item]['quantity']}")
-                print(f"Total: Rs.{record['total']}")
-                print("------------------------------------------")
+            self.lines[product.id] = line
+        self.plain = not self.lines and self.default == self.NO_DISCOUNT
+        self.version += 1
+        self.stamps[product.id] = self.version
+
+    def reprice(self, product, price):
+        product.price = price
+        self.version += 1
+        self.stamps[product.id] = self.version
+
+    def report(self):
+        lines = ["Categories:"] + [f"  {name}: {json.dumps(category)}" for name, category in self.categories.items()]
+        lines.append("Rules:")
+        lines += [f"  {number}. {json.dumps(rule)}" for number, rule in enumerate(self.rules, 1)]
+        if not self.rules:
+            lines.append("  No promotions.")
+        return '\n'.join(lines)
+
+    # Whether pricing any of these products changed after "version".
+    def changed_since(self, version, product_ids):
+        if self.everything > version:
+            return True
+        stamps = self.stamps
+        return any(stamps.get(product_id, 0) > version for product_id in product_ids)
 
 #Manages the products added by the customer and calculates the total price.
+#The total is memoized: add_product/remove_product adjust it by the changed line's difference in O(1), and
+#it is only recomputed when a rule or price change touched one of the cart's products (see PricingEngine).
+#Code filling "items" directly must start from a new cart, or go through set_quantity.
 class ShoppingCart:
-    def __init__(self):
+    __slots__ = ('items', 'catalog', 'coupon', '_total', '_version')
+    NO_PRICING = PricingEngine()
+
+    def __init__(self, catalog=None):
         self.items = {}
+        self.catalog = catalog
+        self.coupon = None
+        self._total = None
+        self._version = 0
+
+    # The memoized total belongs to this process's PricingEngine versions, so it is not pickled (startup snapshot).
+    def __getstate__(self):
+        return {'items': self.items, 'catalog': self.catalog, 'coupon': self.coupon}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._total = None
+        self._version = 0
+
+    def pricing(self):
+        return self.catalog.pricing if self.catalog is not None else self.NO_PRICING
+
+    # Moves the memoized total along with one line going from "old" to "new" units.
+    def _adjust(self, product, old, new):
+        if self._total is not None:
+            engine = self.pricing()
+            if self._version != engine.version:
+                if engine.changed_since(self._version, self.items):
+                    self._total = None
+                    return
+                self._version = engine.version
+            if engine.plain:
+                self._total += product.price * (new - old)
+            else:
+                self._total += engine.line_total(product, new) - engine.line_total(product, old)
 
     def add_product(self, product, quantity):
         if product.id in self.items:
-            self.items[product.id]['quantity'] += quantity
+            line = self.items[product.id]
+            self._adjust(product, line.quantity, line.quantity + quantity)
+            line.quantity += quantity
         else:
-            self.items[product.id] = {'product': product, 'quantity': quantity}
+            self._adjust(product, 0, quantity)
+            self.items[product.id] = CartLine(product, quantity)
         print(f"{quantity} {product.name} added to your cart.")
 
     def remove_product(self, product, quantity):
         if product.id in self.items:
-            if self.items[product.id]['quantity'] > quantity:
+            if self.items[product.id].quantity > quantity:
                 if quantity>0:
-                    self.items[product.id]['quantity'] -= quantity
+                    line = self.items[product.id]
+                    self._adjust(product, line.quantity, line.quantity - quantity)
+                    line.quantity -= quantity
                     print(f"{quantity} {product.name} removed from cart.")
                 else:
                     print(f"Can't remove \"{quantity}\" {product.name} from your cart!")
-            elif self.items[product.id]['quantity'] == quantity:
+            elif self.items[product.id].quantity == quantity:
+                self._adjust(product, quantity, 0)
                 del self.items[product.id]
                 print(f"{quantity} {product.name} removed from cart.")
             else:
-                print(f"Cannot remove {quantity} {product.name} as only {self.items[product.id]['quantity']} is available in the cart.")
+                print(f"Cannot remove {quantity} {product.name} as only {self.items[product.id].quantity} is available in the cart.")
         else:
             print("This Product is not in your cart!")
 
+    # Sets a line to an absolute quantity (0 drops it) without printing; used when replaying the account log.
+    def set_quantity(self, product_id, quantity, product=None):
+        line = self.items.get(product_id)
+        if line is not None and line.product is not None:
+            self._adjust(line.product, line.quantity, 0)
+        if quantity:
+            line = CartLine(product, quantity)
+            self.items[product_id] = line
+            if product is not None:
+                self._adjust(product, 0, quantity)
+            else:
+                self._total = None
+        else:
+            self.items.pop(product_id, None)
+
+    def apply_coupon(self, code):
+        code = code.strip().upper()
+        if code not in self.pricing().coupons:
+            print(f"\"{code}\" is not a valid coupon code.")
+            return False
+        self.coupon = code
+        print(f"Coupon {code} applied.")
+        return True
+
     def view_cart(self):
         if not self.items:
             print("There is nothing in your Cart! Add Some Products.\nTotal: Rs. 0.0")
         else:
-            for item in self.items.values():
-                product = item['product']
-                print(f"--{product.name}: Rs.{product.price} each x quantity: {item['quantity']} ")
-            print(f"Total: Rs. {self.calculate_total()}")
+            engine = self.pricing()
+            for product_id, line in self.items.items():
+                product = line.product
+                if product is None:
+                    print(f"--Product #{product_id} (no longer in store) x quantity: {line.quantity}")
+                    continue
+                price = engine.line_total(product, line.quantity)
+                offer = f"-> Rs.{price} after offers" if price != product.price * line.quantity else ""
+                print(f"--{product.name} (ID {product.id}): Rs.{product.price} each x quantity: {line.quantity} {offer}")
+            subtotal, total = self.subtotal(), self.calculate_total()
+            if self.coupon is not None:
+                print(f"Subtotal: Rs. {subtotal}\nCoupon {self.coupon}: -Rs. {round(subtotal - total, 2)}")
+            print(f"Total: Rs. {total}")
+
+    # The sum of the line prices after product offers, before any coupon.
+    def subtotal(self):
+        engine = self.pricing()
+        if self._total is None or (self._version != engine.version and engine.changed_since(self._version, self.items)):
+            if engine.plain:
+                self._total = sum(line.product.price * line.quantity for line in self.items.values() if line.product is not None)
+            else:
+                self._total = sum(engine.line_total(line.product, line.quantity) for line in self.items.values() if line.product is not None)
+            if metrics.enabled:
+                metrics.add("cart.repriced")
+        self._version = engine.version
+        return round(self._total, 2) if isinstance(self._total, float) else self._total
 
     def calculate_total(self):
-        return sum(item['product'].price * item['quantity'] for item in self.items.values())
+        return self.pricing().apply_coupon(self.subtotal(), self.coupon)
 
     def clear_cart(self):
         self.items.clear()
+        self.coupon = None
+        self._total, self._version = 0, self.pricing().version
 
 # Inherits from User and overrides view_products, allowing admins to manage the product list.
 class Admin(User):
+    __slots__ = ()
+
     def login(self, username, password):
-        return self.username == username and self.password == password
+        if self.username != username:
+            return False
+        try:
+            return credentials.verify(username, self.password, password)
+        except ShoppingCartException as e:
+            print(e)
+            return False
 
-    def view_products(self, products):
-        print("-------------------------------------------------------------------------------")
-        print("| ID. |    Product Name   | Price (Rs) |              Description             |")
-        print("-------------------------------------------------------------------------------")
-        for product in products:
-            print(product)
-        print("-------------------------------------------------------------------------------")
+    def view_products(self, products, page=1, query=None):
+        text, more = render_product_page(products, page, query)
+        print(text)
+        return more
 
     def add_product(self, products, product):
-        products.append(product)
+        products.add(product)
         print(f"Added product: {product.name}")
 
     def remove_product(self, products, product_id):
-        products[:] = [product for product in products if product.id != product_id]
+        products.remove(product_id)
         print(f"Removed product with ID: {product_id}")
 
 #Custom exception for handling shopping cart errors.
 class ShoppingCartException(Exception):
     pass
 
+#Salted password hashes (PBKDF2-HMAC-SHA256) and login checks. A stored password looks like
+#"pbkdf2_sha256$<iterations>$<salt>$<hash>"; "iterations" is the cost and can be changed at any time, since
+#older hashes (and plain text passwords from before hashing) are replaced on the next successful login.
+#Checks run in a thread pool: hashlib releases the GIL while hashing, so checks use every core and a slow
+#check never holds up other sessions.
+#A successful check is remembered for "session_ttl" seconds, keyed by a keyed hash of the attempt (never the
+#password itself), so repeating it skips the hashing; issue() hands out session tokens valid as long.
+#After "max_failures" failed logins within "failure_window" seconds, logins for that user are refused
+#without hashing until the window has passed.
+class Credentials:
+    SCHEME = "pbkdf2_sha256"
+    SWEEP_AFTER = 4096
+
+    def __init__(self, iterations=200000, workers=None, session_ttl=300, max_failures=5, failure_window=60):
+        self.iterations = iterations
+        self.workers = workers or os.cpu_count() or 1
+        self.session_ttl = session_ttl
+        self.max_failures = max_failures
+        self.failure_window = failure_window
+        self.lock = threading.Lock()
+        self.verified = {}
+        self.tokens = {}
+        self.failures = {}
+        self._key = os.urandom(32)
+        self._pool = None
+        self._pool_pid = None
+
+    def hash(self, password, iterations=None, salt=None):
+        iterations = iterations or self.iterations
+        salt = salt or os.urandom(16)
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+        return f"{self.SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+    def is_hashed(self, stored):
+        return stored.startswith(self.SCHEME + "$")
+
+    def needs_rehash(self, stored):
+        return not self.is_hashed(stored) or int(stored.split("$")[1]) != self.iterations
+
+    # The slow part of a login; both branches compare in constant time.
+    def check(self, stored, password):
+        if not self.is_hashed(stored):
+            return hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8"))
+        scheme, iterations, salt, digest = stored.split("$")
+        attempt = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), bytes.fromhex(salt), int(iterations))
+        return hmac.compare_digest(attempt.hex(), digest)
+
+    # A forked child (see AccountWorkerPool) does not inherit the pool's threads, so it starts its own.
+    def pool(self):
+        with self.lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = concurrent_futures.ThreadPoolExecutor(self.workers, thread_name_prefix="credentials")
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    # Starts checking a login and returns a future of True or False.
+    # Raises ShoppingCartException while the user is rate limited.
+    def submit(self, username, stored, password):
+        now = time.monotonic()
+        key = hmac.new(self._key, f"{username}\0{stored}\0{password}".encode("utf-8"), "sha256").digest()
+        with self.lock:
+            failures = [at for at in self.failures.get(username, ()) if now - at < self.failure_window]
+            if len(failures) >= self.max_failures:
+                wait = int(self.failure_window - (now - failures[0])) + 1
+                raise ShoppingCartException(f"Too many failed logins for {username}. Try again in {wait} seconds.")
+            if self.verified.get(key, 0) > now:
+                future = concurrent_futures.Future()
+                future.set_result(True)
+                return future
+        future = self.pool().submit(self.check, stored, password)
+        future.add_done_callback(lambda done: self._record(username, key, done))
+        return future
+
+    def _record(self, username, key, future):
+        now = time.monotonic()
+        with self.lock:
+            if future.exception() is None and future.result():
+                self.failures.pop(username, None)
+                self.verified[key] = now + self.session_ttl
+            else:
+                self.failures[username] = [at for at in self.failures.get(username, ()) if now - at < self.failure_window] + [now]
+            if len(self.verified) + len(self.tokens) > self.SWEEP_AFTER:
+                self.verified = {key: until for key, until in self.verified.items() if until > now}
+                self.tokens = {token: entry for token, entry in self.tokens.items() if entry[1] > now}
+
+    def verify(self, username, stored, password):
+        return self.submit(username, stored, password).result()
+
+    # Hashing a new password costs as much as checking one, so it runs on the pool too; returns a future of the hash.
+    def submit_hash(self, password):
+        return self.pool().submit(self.hash, password)
+
+    def issue(self, username):
+        token = secrets.token_urlsafe(24)
+        with self.lock:
+            self.tokens[token] = (username, time.monotonic() + self.session_ttl)
+        return token
+
+    def revoke(self, token):
+        with self.lock:
+            self.tokens.pop(token, None)
+
+    # The user a session token was issued to, or None once it has expired.
+    def resume(self, token):
+        with self.lock:
+            entry = self.tokens.get(token)
+            if entry is not None and entry[1] <= time.monotonic():
+                del self.tokens[token]
+                entry = None
+        return entry[0] if entry is not None else None
+
+credentials = Credentials()
+
+#Append-only log of account and cart events, replayed on top of the account file at startup.
+#Every append is flushed straight away but only fsync'd once per "fsync_every" events.
+#The first line records which snapshot the log belongs to, so a log that was already
+#folded into a newer snapshot (crash during compaction) is discarded instead of replayed twice.
+class AccountJournal:
+    def __init__(self, filename, fsync_every=16, compact_after=1000):
+        self.filename = filename
+        self.fsync_every = fsync_every
+        self.compact_after = compact_after
+        self.entries = 0
+        self._unsynced = 0
+        self._file = None
+
+    def open(self, base):
+        events = self._read()
+        if events and events[0] == ["base", base]:
+            events = events[1:]
+        else:
+            events = []
+            self.reset(base)
+        self.entries = len(events)
+        return events
+
+    def _read(self):
+        events = []
+        good = 0
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return events
+        for line in data.splitlines(keepends=True):
+            # A torn write from a crash ends the log; everything after it is dropped.
+            if not line.endswith(b'\n'):
+                break
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                break
+            good += len(line)
+        if good != len(data):
+            os.truncate(self.filename, good)
+        return events
+
+    # All events go out in one write; "sync" forces the fsync now (group commit).
+    def append(self, *events, sync=False):
+        if self._file is None:
+            self._file = open(self.filename, 'a')
+        data = ''.join(json.dumps(event) + '\n' for event in events)
+        self._file.write(data)
+        self._file.flush()
+        if metrics.enabled:
+            metrics.add("journal.bytes_written", len(data))
+        self.entries += len(events)
+        self._unsynced += len(events)
+        if sync or self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def needs_compaction(self):
+        return self.entries >= self.compact_after
+
+    def reset(self, base):
+        self.close()
+        with open(self.filename, 'w') as f:
+            f.write(json.dumps(["base", base]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries = 0
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+#Stable 64-bit hash of a username, used as the key of the on-disk account index.
+def username_hash(username):
+    return int.from_bytes(hashlib.blake2b(username.encode('utf-8'), digest_size=8).digest(), 'little')
+
+#Unsigned LEB128 varints, used for lengths and counts in the binary account format.
+def write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+#Old account format: one "username;password;first;last;address;cart;history" line per customer.
+#Only kept to read (and migrate) User_data.txt; a ';' or '|' inside a field corrupts the record.
+class TextAccountCodec:
+    def __init__(self, account_manager):
+        self.account_manager = account_manager
+
+    def encode(self, customer):
+        return (self.account_manager.encode_account(customer) + '\n').encode('utf-8')
+
+    def decode(self, raw):
+        return self.account_manager.decode_account(raw.rstrip(b'\r\n').decode('utf-8'))
+
+    def username(self, raw):
+        return raw.split(b';', 1)[0].decode('utf-8')
+
+    # Yields (username, start, end) for every non-empty line of "data".
+    def scan(self, data):
+        start = 0
+        size = len(data)
+        while start < size:
+            end = data.find(b'\n', start)
+            end = size if end == -1 else end + 1
+            if data[start:end].strip():
+                yield data[start:data.find(b';', start, end)].decode('utf-8'), start, end
+            start = end
+
+    def iter_history(self, raw):
+        yield from self.decode(raw).history
+
+#Binary account format: each record is a varint payload length followed by the payload, so records can be
+#scanned and skipped without parsing them. The payload is a version byte, the five text fields (varint length
+#+ UTF-8), the cart and the history. Numbers are stored in little-endian columns that array() reads and writes
+#in one call, each tagged with the narrowest typecode that holds its values. The history is stored the way
+#PurchaseHistory keeps it: the lifetime spend, then one column per field (dates, totals, lines per order,
+#product ids, quantities), so one order can be read without the others. Version 1 records had no lifetime spend.
+class BinaryAccountCodec:
+    VERSION = 2
+    WIDTHS = (('b', 1 << 7), ('h', 1 << 15), ('i', 1 << 31), ('q', 1 << 63))
+    SWAP = sys.byteorder != 'little'
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def _write_column(self, out, values):
+        low = min(values, default=0)
+        high = max(values, default=0)
+        for typecode, limit in self.WIDTHS:
+            if -limit <= low and high < limit:
+                break
+        column = array(typecode, values)
+        if self.SWAP:
+            column.byteswap()
+        out.append(ord(typecode))
+        out += column.tobytes()
+
+    def _read_column(self, data, pos, count):
+        column = array(chr(data[pos]))
+        pos += 1
+        end = pos + column.itemsize * count
+        column.frombytes(data[pos:end])
+        if self.SWAP:
+            column.byteswap()
+        return column, end
+
+    def _skip_column(self, data, pos, count):
+        return pos + 1 + array(chr(data[pos])).itemsize * count
+
+    def _write_text(self, out, text):
+        data = text.encode('utf-8')
+        write_varint(out, len(data))
+        out += data
+
+    def _read_text(self, data, pos):
+        length, pos = read_varint(data, pos)
+        end = pos + length
+        return str(data[pos:end], 'utf-8'), end
+
+    def encode(self, customer):
+        payload = bytearray((self.VERSION,))
+        for text in (customer.username, customer.password, customer.first_name, customer.last_name, customer.address):
+            self._write_text(payload, text)
+        items = customer.cart.items
+        write_varint(payload, len(items))
+        self._write_column(payload, items.keys())
+        self._write_column(payload, [line.quantity for line in items.values()])
+        history = customer.history
+        write_varint(payload, len(history))
+        if history:
+            totals = array('d', [history.spent])
+            totals.extend(history.totals)
+            if self.SWAP:
+                totals.byteswap()
+            payload += totals[:1].tobytes()
+            self._write_text(payload, '\n'.join(history.dates))
+            payload += totals[1:].tobytes()
+            offsets = history.offsets
+            self._write_column(payload, [offsets[i + 1] - offsets[i] for i in range(len(history))])
+            self._write_column(payload, history.product_ids)
+            self._write_column(payload, history.quantities)
+        out = bytearray()
+        write_varint(out, len(payload))
+        out += payload
+        return bytes(out)
+
+    # Returns the position of the payload (just past the version byte), the end of the record at "pos"
+    # and the record's version.
+    def _payload(self, data, pos=0):
+        length, start = read_varint(data, pos)
+        version = data[start]
+        if not 1 <= version <= self.VERSION:
+            raise ValueError(f"Unsupported account record version {version}")
+        return start + 1, start + length, version
+
+    def username(self, raw):
+        pos, end, version = self._payload(raw)
+        return self._read_text(raw, pos)[0]
+
+    # Yields (username, start, end) for every record of "data"; a record cut short at the end is ignored.
+    def scan(self, data):
+        pos = 0
+        size = len(data)
+        while pos < size:
+            start = pos
+            payload, pos, version = self._payload(data, start)
+            if pos > size:
+                return
+            yield self._read_text(data, payload)[0], start, pos
+
+    def _read_cart(self, data, pos):
+        count, pos = read_varint(data, pos)
+        product_ids, pos = self._read_column(data, pos, count)
+        quantities, pos = self._read_column(data, pos, count)
+        cart = ShoppingCart(self.catalog)
+        for product_id, quantity in zip(product_ids, quantities):
+            cart.items[product_id] = CartLine(self.catalog.get(product_id), quantity)
+        return cart, pos
+
+    def _read_doubles(self, data, pos, count):
+        values = array('d')
+        values.frombytes(data[pos:pos + 8 * count])
+        if self.SWAP:
+            values.byteswap()
+        return values, pos + 8 * count
+
+    # Reads the history header: order count, lifetime spend (None in version 1), the span of the date block,
+    # and the totals and line-count columns.
+    def _read_history(self, data, pos, version):
+        count, pos = read_varint(data, pos)
+        if not count:
+            return 0, 0.0, None, None, None, pos
+        spent = None
+        if version >= 2:
+            spent, pos = self._read_doubles(data, pos, 1)
+            spent = spent[0]
+        length, dates = read_varint(data, pos)
+        totals, pos = self._read_doubles(data, dates + length, count)
+        counts, pos = self._read_column(data, pos, count)
+        return count, spent, (dates, dates + length), totals, counts, pos
+
+    def decode(self, raw):
+        data = memoryview(raw)
+        pos, end, version = self._payload(data)
+        fields = []
+        for _ in range(5):
+            text, pos = self._read_text(data, pos)
+            fields.append(text)
+        cart, pos = self._read_cart(data, pos)
+        count, spent, dates, totals, counts, pos = self._read_history(data, pos, version)
+        if not count:
+            return Customer(*fields, cart, PurchaseHistory(self.catalog))
+        total_lines = sum(counts)
+        product_ids, pos = self._read_column(data, pos, total_lines)
+        quantities, pos = self._read_column(data, pos, total_lines)
+        history = PurchaseHistory.from_columns(self.catalog, str(data[dates[0]:dates[1]], 'utf-8').split('\n'), totals, counts,
+                                               product_ids, quantities, spent)
+        return Customer(*fields, cart, history)
+
+    # Decodes a customer's orders one at a time, oldest first, without building the Customer or the rest
+    # of the history.
+    def iter_history(self, raw):
+        pos, end, version = self._payload(raw)
+        for _ in range(5):
+            length, pos = read_varint(raw, pos)
+            pos += length
+        count, pos = read_varint(raw, pos)
+        pos = self._skip_column(raw, self._skip_column(raw, pos, count), count)
+        count, spent, dates, totals, counts, pos = self._read_history(raw, pos, version)
+        if not count:
+            return
+        total_lines = sum(counts)
+        ids_type, ids = chr(raw[pos]), pos + 1
+        quantities_type, quantities = chr(raw[self._skip_column(raw, pos, total_lines)]), self._skip_column(raw, pos, total_lines) + 1
+        ids_size = array(ids_type).itemsize
+        quantities_size = array(quantities_type).itemsize
+        date_start, date_end = dates
+        for total, lines in zip(totals, counts):
+            date_stop = raw.find(b'\n', date_start, date_end)
+            if date_stop == -1:
+                date_stop = date_end
+            product_ids = array(ids_type)
+            product_ids.frombytes(raw[ids:ids + ids_size * lines])
+            order_quantities = array(quantities_type)
+            order_quantities.frombytes(raw[quantities:quantities + quantities_size * lines])
+            if self.SWAP:
+                product_ids.byteswap()
+                order_quantities.byteswap()
+            yield OrderRecord(raw[date_start:date_stop].decode('utf-8'), product_ids, order_quantities, total, self.catalog)
+            date_start = date_stop + 1
+            ids += ids_size * lines
+            quantities += quantities_size * lines
+
+#Indexed, lazily-loaded view of the account file, used as AccountManager.accounts.
+#Startup only maps the offset index (<account file>.idx); a customer's record is read and decoded (by the
+#account codec) on first access and kept in a bounded LRU cache. A dirty customer evicted from the cache is
+#written back as an encoded record that the next compaction folds into the account file.
+#Catalog events (stock levels) share the log so an order and its stock change commit together; they are
+#kept in order in "catalog_events" and "save_catalog" persists the catalog before they are compacted away.
+class AccountStore:
+    INDEX_MAGIC = b'UIDX'
+    INDEX_VERSION = 1
+    INDEX_HEADER = struct.Struct('<4sIqq')
+    INDEX_ENTRY = struct.Struct('<QQQ')
+    CATALOG_EVENTS = ("stock",)
+
+    def __init__(self, filename, codec, apply_event, capacity=1024, save_catalog=None):
+        self.filename = filename
+        self.codec = codec
+        self.apply_event = apply_event
+        self.save_catalog = save_catalog
+        self.capacity = capacity
+        self.catalog_events = []
+        self.cache = OrderedDict()
+        self.dirty = set()
+        self.written_back = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self._index = None
+        self._count = 0
+        self.journal = AccountJournal(filename + ".log")
+        self._open_index()
+        # Crash recovery: events logged since the last compaction are kept per user and
+        # re-applied when that user is loaded.
+        for event in self.journal.open(self.snapshot_stamp()):
+            if event[0] in self.CATALOG_EVENTS:
+                self.catalog_events.append(event)
+            else:
+                self.pending.setdefault(event[1], []).append(event)
+
+    def snapshot_stamp(self):
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _open_index(self, rebuild=True):
+        stamp = self.snapshot_stamp()
+        if stamp is None:
+            return
+        try:
+            with open(self.filename + ".idx", 'rb') as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, size, mtime = self.INDEX_HEADER.unpack_from(index)
+            if (magic, version, [size, mtime]) == (self.INDEX_MAGIC, self.INDEX_VERSION, stamp):
+                self._index = index
+                self._count = (len(index) - self.INDEX_HEADER.size) // self.INDEX_ENTRY.size
+                return
+            index.close()
+        except (FileNotFoundError, ValueError, struct.error):
+            pass
+        # Missing or stale index (e.g. the account file was edited by hand): rebuild it with one scan.
+        if rebuild:
+            entries = [(username_hash(username), start, end - start) for username, start, end in self._scan()]
+            self._write_index(entries, stamp)
+            self._open_index(rebuild=False)
+
+    def _write_index(self, entries, stamp):
+        entries.sort()
+        with open(self.filename + ".idx", 'wb') as f:
+            f.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC, self.INDEX_VERSION, *stamp))
+            f.write(b''.join(self.INDEX_ENTRY.pack(*entry) for entry in entries))
+
+    def _close_index(self):
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+            self._count = 0
+
+    # Maps the account file for a sequential pass; None when there is nothing to read.
+    def _map_snapshot(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    # Yields (username, start, end) for every record of the account file, in file order.
+    def _scan(self):
+        data = self._map_snapshot()
+        if data is None:
+            return
+        with data:
+            yield from self.codec.scan(data)
+
+    # Binary search of the mapped index, then one seek + read of the matching record.
+    def _find(self, username):
+        if self._index is None:
+            return None
+        key = username_hash(username)
+        header, entry = self.INDEX_HEADER.size, self.INDEX_ENTRY
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if entry.unpack_from(self._index, header + mid * entry.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        with open(self.filename, 'rb') as f:
+            while lo < self._count:
+                entry_hash, offset, length = entry.unpack_from(self._index, header + lo * entry.size)
+                if entry_hash != key:
+                    break
+                f.seek(offset)
+                raw = f.read(length)
+                if metrics.enabled:
+                    metrics.add("accounts.bytes_read", length)
+                if self.codec.username(raw) == username:
+                    return raw
+                lo += 1
+        return None
+
+    # The stored record of a user, as last compacted or written back; logged events are not applied.
+    def raw_record(self, username):
+        with self.lock:
+            raw = self.written_back.get(username)
+            return raw if raw is not None else self._find(username)
+
+    def _build(self, username):
+        raw = self.raw_record(username)
+        customer = self.codec.decode(raw) if raw is not None else None
+        for event in self.pending.get(username, ()):
+            customer = self.apply_event(customer, event)
+        return customer
+
+    def _cache(self, username, customer):
+        self.cache[username] = customer
+        self.cache.move_to_end(username)
+        while len(self.cache) > self.capacity:
+            evicted, evicted_customer = self.cache.popitem(last=False)
+            if evicted in self.dirty:
+                self.written_back[evicted] = self._encode(evicted_customer)
+                self.pending.pop(evicted, None)
+                self.dirty.discard(evicted)
+
+    # Customers in the cache may be changing in session threads; their lock keeps the record consistent.
+    def _encode(self, customer):
+        with customer.lock:
+            return self.codec.encode(customer)
+
+    def __contains__(self, username):
+        with self.lock:
+            return (username in self.cache or username in self.written_back or username in self.pending
+                    or self._find(username) is not None)
+
+    def __getitem__(self, username):
+        with self.lock:
+            customer = self.cache.get(username)
+            if customer is not None:
+                self.hits += 1
+                self.cache.move_to_end(username)
+                return customer
+            self.misses += 1
+            customer = self._build(username)
+            if customer is None:
+                raise KeyError(username)
+            self._cache(username, customer)
+            return customer
+
+    def __setitem__(self, username, customer):
+        with self.lock:
+            self._cache(username, customer)
+            self.dirty.add(username)
+
+    def get(self, username, default=None):
+        try:
+            return self[username]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        seen = set()
+        for username, start, end in self._scan():
+            seen.add(username)
+            yield username
+        for username in list(self.cache) + list(self.written_back) + list(self.pending):
+            if username not in seen:
+                seen.add(username)
+                yield username
+
+    # Walks every account without filling the cache, so a full pass keeps memory bounded.
+    def items(self):
+        for username in self:
+            yield username, self._current(username)
+
+    def log(self, *events, sync=False):
+        with self.lock:
+            self.journal.append(*events, sync=sync)
+            for event in events:
+                if event[0] in self.CATALOG_EVENTS:
+                    self.catalog_events.append(event)
+                elif event[1] in self.cache:
+                    self.dirty.add(event[1])
+                else:
+                    self.pending.setdefault(event[1], []).append(event)
+            if self.journal.needs_compaction():
+                self.compact()
+
+    def _current(self, username):
+        with self.lock:
+            customer = self.cache.get(username)
+            return customer if customer is not None else self._build(username)
+
+    # Compaction: streams the account file into a new one, re-serializing only the users that changed
+    # and copying everyone else verbatim, then swaps it in atomically, rebuilds the index and starts a fresh log.
+    def compact(self):
+        with self.lock:
+            if self.catalog_events and self.save_catalog is not None:
+                self.save_catalog()
+            temp_filename = self.filename + ".tmp"
+            entries = []
+            seen = set()
+            snapshot = self._map_snapshot()
+            with open(temp_filename, 'wb') as file:
+                def write(username, raw):
+                    entries.append((username_hash(username), file.tell(), len(raw)))
+                    file.write(raw)
+                if snapshot is not None:
+                    with snapshot:
+                        for username, start, end in self.codec.scan(snapshot):
+                            seen.add(username)
+                            if username in self.dirty or username in self.written_back or username in self.pending:
+                                write(username, self._encode(self._current(username)))
+                            else:
+                                write(username, snapshot[start:end])
+                for username in list(self.cache) + list(self.written_back) + list(self.pending):
+                    if username not in seen:
+                        seen.add(username)
+                        write(username, self._encode(self._current(username)))
+                file.flush()
+                os.fsync(file.fileno())
+                if metrics.enabled:
+                    metrics.add("accounts.bytes_written", file.tell())
+            self._close_index()
+            os.replace(temp_filename, self.filename)
+            stamp = self.snapshot_stamp()
+            self._write_index(entries, stamp)
+            self._open_index()
+            self.journal.reset(stamp)
+            self.catalog_events.clear()
+            self.pending.clear()
+            self.written_back.clear()
+            self.dirty.clear()
+
+    # True when compaction would write anything (changed users or logged stock levels).
+    def has_changes(self):
+        with self.lock:
+            return bool(self.dirty or self.written_back or self.pending or self.catalog_events)
+
+    def close(self):
+        with self.lock:
+            self.journal.close()
+            self._close_index()
+
+#This class splits the accounts across several AccountStores ("shards") by username hash. Each shard has its
+#own account file, index, log and lock, so work on one user only touches that user's shard. The shard count is
+#kept in a small manifest file next to the accounts; with one shard the account file keeps its usual name.
+#"owned" limits the shards opened by this process (the others belong to another worker of an AccountWorkerPool).
+#Catalog events always go to shard 0, which is the only shard that saves the catalog.
+class ShardedAccountStore:
+    def __init__(self, filename, count, codec, apply_event, capacity=1024, save_catalog=None, owned=None):
+        self.filename = filename
+        self.count = count
+        self.owned = range(count) if owned is None else sorted(owned)
+        capacity = max(1, -(-capacity // count))
+        self.shards = [None] * count
+        for index in self.owned:
+            self.shards[index] = AccountStore(self.shard_filename(filename, count, index), codec, apply_event, capacity,
+                                              save_catalog if index == 0 else None)
+
+    @staticmethod
+    def shard_filename(filename, count, index):
+        if count == 1:
+            return filename
+        root, extension = os.path.splitext(filename)
+        return f"{root}.{index}-of-{count}{extension}"
+
+    @staticmethod
+    def manifest_filename(filename):
+        return filename + ".shards"
+
+    # Shard count recorded for an account file; a store without a manifest has a single shard.
+    @staticmethod
+    def read_count(filename):
+        try:
+            with open(ShardedAccountStore.manifest_filename(filename), 'r') as f:
+                return int(json.load(f)["shards"])
+        except FileNotFoundError:
+            return 1
+
+    @staticmethod
+    def write_count(filename, count):
+        manifest = ShardedAccountStore.manifest_filename(filename)
+        with open(manifest + ".tmp", 'w') as f:
+            json.dump({"shards": count}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest + ".tmp", manifest)
+
+    def shard_index(self, username):
+        return username_hash(username) % self.count
+
+    # The AccountStore holding a user.
+    def shard(self, username):
+        index = self.shard_index(username)
+        store = self.shards[index]
+        if store is None:
+            raise ShoppingCartException(f"Account {username} is in shard {index}, which this process does not serve.")
+        return store
+
+    def stores(self):
+        return [self.shards[index] for index in self.owned]
+
+    @property
+    def catalog_events(self):
+        return self.shards[0].catalog_events if self.shards[0] is not None else []
+
+    @property
+    def hits(self):
+        return sum(store.hits for store in self.stores())
+
+    @property
+    def misses(self):
+        return sum(store.misses for store in self.stores())
+
+    def snapshot_stamp(self):
+        stamps = [store.snapshot_stamp() for store in self.stores()]
+        return None if all(stamp is None for stamp in stamps) else stamps
+
+    def raw_record(self, username):
+        return self.shard(username).raw_record(username)
+
+    def __contains__(self, username):
+        return username in self.shard(username)
+
+    def __getitem__(self, username):
+        return self.shard(username)[username]
+
+    def __setitem__(self, username, customer):
+        self.shard(username)[username] = customer
+
+    def get(self, username, default=None):
+        return self.shard(username).get(username, default)
+
+    def __iter__(self):
+        for store in self.stores():
+            yield from store
+
+    def items(self):
+        for store in self.stores():
+            yield from store.items()
+
+    # Events are grouped per shard and each group is appended with one write. Catalog events go first, to
+    # shard 0: a crash between two shards can then lose an order but never sell stock twice.
+    def log(self, *events, sync=False):
+        if self.count == 1:
+            self.shards[0].log(*events, sync=sync)
+            return
+        groups = {}
+        for event in events:
+            index = 0 if event[0] in AccountStore.CATALOG_EVENTS else self.shard_index(event[1])
+            groups.setdefault(index, []).append(event)
+        for index in sorted(groups):
+            if self.shards[index] is None:
+                raise ShoppingCartException(f"Shard {index} is not served by this process.")
+            self.shards[index].log(*groups[index], sync=sync)
+
+    # Compacts the shard of one user, or every shard with changes.
+    def compact(self, username=None):
+        if username is not None:
+            self.shard(username).compact()
+            return
+        for store in self.stores():
+            if store.has_changes():
+                store.compact()
+
+    # Cached customers of every open shard, least recently used first.
+    def cached(self):
+        return [item for store in self.stores() for item in store.cache.items()]
+
+    # Puts customers restored from a startup snapshot back into their shard's cache.
+    def preload(self, customers):
+        for username, customer in customers:
+            store = self.shard(username)
+            with store.lock:
+                store._cache(username, customer)
+
+    def close(self):
+        for store in self.stores():
+            store.close()
+
+#This class keeps the resolved state of a loaded store in one pickle file, read back with a single read on the
+#next start: the catalog's by-id index (so the product records are not scanned again) and the customers
+#that were in the account cache, with their carts and histories already decoded.
+#A snapshot is only used when this program and every source file (catalog, pricing rules, shard manifest,
+#account files and their logs) are unchanged since it was written. Sources are compared by size, modification time and a
+#hash of their first and last SAMPLE bytes; hashing whole data files would cost more than the snapshot saves.
+class StartupSnapshot:
+    VERSION = 1
+    SAMPLE = 65536
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @classmethod
+    def fingerprint(cls, filename):
+        try:
+            with open(filename, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                digest = hashlib.blake2b(f.read(cls.SAMPLE), digest_size=16)
+                if stat.st_size > cls.SAMPLE:
+                    f.seek(max(cls.SAMPLE, stat.st_size - cls.SAMPLE))
+                    digest.update(f.read(cls.SAMPLE))
+        except FileNotFoundError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+
+    @staticmethod
+    def program_hash():
+        try:
+            with open(__file__, 'rb') as f:
+                return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+        except (NameError, OSError):
+            return None
+
+    # The saved snapshot if it was written by this program for exactly these sources, otherwise None.
+    def read(self, sources):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+            snapshot = pickle.loads(data)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, ValueError) as e:
+            print(f"Ignoring startup snapshot: {e}")
+            return None
+        if not isinstance(snapshot, dict) or snapshot.get("version") != self.VERSION:
+            return None
+        if snapshot.get("program") != self.program_hash() or snapshot.get("sources") != sources:
+            return None
+        return snapshot
+
+    # The catalog index is split into record positions (None for products already looked up), pickled as
+    # plain data, and the looked-up products themselves.
+    def write(self, sources, catalog_state, customers, catalog):
+        positions = {product_id: value if type(value) is int else None for product_id, value in catalog_state.items()}
+        products = [value for value in catalog_state.values() if type(value) is not int]
+        snapshot = {"version": self.VERSION, "program": self.program_hash(), "sources": sources, "positions": positions,
+                    "products": self.dumps(products), "customers": self.dumps(customers, catalog)}
+        with open(self.filename + ".tmp", 'wb') as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.filename + ".tmp", self.filename)
+
+    # Classes of this program are pickled by name (it may be loaded under any module name), and with a
+    # catalog, products and the catalog itself are pickled as references to be re-linked on load.
+    @staticmethod
+    def dumps(value, catalog=None):
+        def persistent_id(item):
+            if isinstance(item, type) and item.__module__ == __name__:
+                return ("class", item.__name__)
+            if catalog is not None:
+                if item is catalog:
+                    return ("catalog",)
+                if type(item) is Product:
+                    return ("product", item.id)
+            return None
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(value)
+        return buffer.getvalue()
+
+    @staticmethod
+    def loads(data, catalog=None):
+        def persistent_load(key):
+            if key[0] == "class":
+                return globals()[key[1]]
+            return catalog if key[0] == "catalog" else catalog.get(key[1])
+        unpickler = pickle.Unpickler(io.BytesIO(data))
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+    @classmethod
+    def catalog_state(cls, snapshot):
+        state = snapshot["positions"]
+        for product in cls.loads(snapshot["products"]):
+            state[product.id] = product
+        return state
+
 #This class loads and saves products and accounts. Also manage creation of account and login.
 class AccountManager:
-    def __init__(self, products=[], filename="User_data.txt"):
-        self.products = products
+    def __init__(self, products=None, filename="User_data.dat", cache_size=1024, product_filename="product_data.bin", codec=None,
+                 shards=None, owned=None, snapshot=False, pricing_filename="pricing_rules.json"):
+        self.products = products if isinstance(products, ProductCatalog) else ProductCatalog(products or ())
         self.filename = filename
-        self.load_products()
+        self.legacy_filename = "User_data.txt"
+        self.product_filename = product_filename
+        self.legacy_product_filename = "product_data.txt"
+        self.pricing_filename = pricing_filename
+        self.codec = codec if codec is not None else BinaryAccountCodec(self.products)
+        self.lock = threading.RLock()
+        # The catalog's own lock: readers in session threads take it too (see ProductCatalog).
+        self.products_lock = self.products.lock
+        self.cache_size = cache_size
+        self.shards = shards
+        self.owned = owned
+        self.checkouts = CheckoutPipeline(self)
+        # Snapshot mode (see StartupSnapshot) is for a process that owns the whole store.
+        self.snapshot = StartupSnapshot(filename + ".snapshot") if snapshot and owned is None else None
+        restored = self.snapshot.read(self.snapshot_sources()) if self.snapshot is not None else None
+        self.load_products(StartupSnapshot.catalog_state(restored) if restored else None)
+        self.load_pricing()
         self.load_accounts()
+        if restored:
+            self.accounts.preload(StartupSnapshot.loads(restored["customers"], self.products))
 
     def save_products(self):
         try:
-            with open('product_data.txt', 'w') as f:
-                pdts = [[item.id, item.name, item.price, item.description] for item in self.products]
-                f.write(str(pdts))
+            with self.products_lock:
+                self.products.save_binary(self.product_filename)
         except IOError as e:
             print(f"Error saving products: {e}")
 
-    def load_products(self):
+    def load_products(self, state=None):
         try:
-            with open('product_data.txt', 'r') as f:
-                data = eval(f.read())
-                self.products.extend(Product(item[0], item[1], item[2], item[3]) for item in data)
+            if os.path.exists(self.product_filename):
+                self.products.load_binary(self.product_filename, state)
+            else:
+                # One-time migration from the old text catalog to the binary format.
+                self.products.extend(self.load_legacy_products())
+                self.save_products()
         except FileNotFoundError:
             print("No product data file found.")
-        except (IOError, ValueError) as e:
+        except (IOError, ValueError, SyntaxError) as e:
             print(f"Error loading products: {e}")
 
-    def load_accounts(self):
-        self.accounts = {}
-        try:
-            with open(self.filename, 'r') as file:
-                for line in file:
-                    data = line.strip().split(';')
-                    username, password, first_name, last_name, address = data[:5]
-                    cart_data = data[5]
-                    history_data = data[6:]
-                    cart = self.deserialize_cart(cart_data)
-                    history = self.deserialize_history(history_data)
-                    self.accounts[username] = Customer(username, password, first_name, last_name, address, cart, history)
+    # Promotion rules (see PricingEngine): {"categories": {...}, "rules": [...]}. No file means no promotions.
+    def load_pricing(self):
+        try:
+            with open(self.pricing_filename, 'r') as f:
+                data = json.load(f)
+            self.products.pricing.set_rules(data.get("rules", []), data.get("categories", {}))
         except FileNotFoundError:
+            pass
+        except (IOError, ValueError, AttributeError) as e:
+            print(f"Error loading pricing rules: {e}")
+
+    def save_pricing(self):
+        pricing = self.products.pricing
+        try:
+            with open(self.pricing_filename + ".tmp", 'w') as f:
+                json.dump({"categories": pricing.categories, "rules": pricing.rules}, f, indent=2)
+            os.replace(self.pricing_filename + ".tmp", self.pricing_filename)
+        except IOError as e:
+            print(f"Error saving pricing rules: {e}")
+
+    # Raises ValueError (keeping the current rules) if any rule is invalid.
+    def set_pricing(self, rules, categories=None):
+        pricing = self.products.pricing
+        with self.products_lock:
+            pricing.set_rules(rules, pricing.categories if categories is None else categories)
+            self.save_pricing()
+
+    def change_price(self, product_id, price):
+        if price < 0:
+            raise ShoppingCartException("The price can't be negative.")
+        with self.products_lock:
+            product = self.products.set_price(product_id, price)
+        self.save_products()
+        return product
+
+    # Reads the old product_data.txt (a Python list literal) without executing it.
+    def load_legacy_products(self):
+        with open(self.legacy_product_filename, 'r') as f:
+            data = ast.literal_eval(f.read())
+        return [Product(*item[:5]) for item in data]
+
+    # Only opens the account indexes; customers are parsed when they are first looked up.
+    # Stock levels logged since the last compaction are re-applied to the catalog straight away.
+    # Asking for a different shard count than the one on disk rebalances the accounts first.
+    def load_accounts(self):
+        count = ShardedAccountStore.read_count(self.filename)
+        if count == 1 and not os.path.exists(self.filename) and os.path.exists(self.legacy_filename):
+            try:
+                self.migrate_accounts()
+            except (IOError, ValueError) as e:
+                print(f"Error migrating accounts: {e}")
+        self.accounts = ShardedAccountStore(self.filename, count, self.codec, self.apply_event, self.cache_size,
+                                            self.save_products, self.owned)
+        metrics.caches["accounts"] = self.accounts
+        for event in self.accounts.catalog_events:
+            self.apply_catalog_event(event)
+        if self.shards is not None and self.shards != count and self.owned is None:
+            self.rebalance(self.shards)
+        if self.accounts.snapshot_stamp() is None:
             print("No account data file found.")
-        except Exception as e:
-            print(f"Error loading accounts: {e}")
 
-    def save_accounts(self):
+    # Compacts only the shard of "username" when given, otherwise every shard that changed.
+    def save_accounts(self, username=None):
         try:
-            with open(self.filename, 'w') as file:
-                for username, customer in self.accounts.items():
-                    cart_data = self.serialize_cart(customer.cart)
-                    history_data = self.serialize_history(customer.history)
-                    file.write(f"{customer.username};{customer.password};{customer.first_name};{customer.last_name};{customer.address};{cart_data};{history_data}\n")
+            self.accounts.compact(username)
         except IOError as e:
             print(f"Error saving accounts: {e}")
 
+    # Changes the number of account shards. The current shards are compacted, their records are copied
+    # verbatim into the new shard files, and the manifest is switched last, so a crash part way through
+    # leaves the old shards in use. The old files are removed afterwards.
+    def rebalance(self, count):
+        if count < 1:
+            print("The number of shards must be at least 1.")
+            return
+        with self.lock:
+            old = self.accounts
+            if count == old.count:
+                return
+            try:
+                old.compact()
+                new_filenames = [ShardedAccountStore.shard_filename(self.filename, count, index) for index in range(count)]
+                files = [open(filename + ".tmp", 'wb') for filename in new_filenames]
+                try:
+                    for store in old.stores():
+                        snapshot = store._map_snapshot()
+                        if snapshot is None:
+                            continue
+                        with snapshot:
+                            for username, start, end in self.codec.scan(snapshot):
+                                files[username_hash(username) % count].write(snapshot[start:end])
+                    for file in files:
+                        file.flush()
+                        os.fsync(file.fileno())
+                finally:
+                    for file in files:
+                        file.close()
+                old_filenames = [old.shard_filename(self.filename, old.count, index) for index in range(old.count)]
+                old.close()
+                for filename in new_filenames:
+                    for suffix in (".idx", ".log"):
+                        if os.path.exists(filename + suffix):
+                            os.remove(filename + suffix)
+                    os.replace(filename + ".tmp", filename)
+                ShardedAccountStore.write_count(self.filename, count)
+                for filename in old_filenames:
+                    for suffix in ("", ".idx", ".log"):
+                        if os.path.exists(filename + suffix):
+                            os.remove(filename + suffix)
+            except IOError as e:
+                print(f"Error rebalancing accounts: {e}")
+                old.close()
+                count = ShardedAccountStore.read_count(self.filename)
+            self.accounts = ShardedAccountStore(self.filename, count, self.codec, self.apply_event, self.cache_size,
+                                                self.save_products)
+            metrics.caches["accounts"] = self.accounts
+        print(f"Accounts are now stored in {count} shard(s).")
+
+    # One-time migration from the old text account file (and its log) to the current account format.
+    # The old files are left in place; they are ignored once the new account file exists.
+    def migrate_accounts(self):
+        legacy = AccountStore(self.legacy_filename, TextAccountCodec(self), self.apply_event, 1)
+        try:
+            if legacy.catalog_events:
+                for event in legacy.catalog_events:
+                    self.apply_catalog_event(event)
+                self.save_products()
+            temp_filename = self.filename + ".tmp"
+            with open(temp_filename, 'wb') as file:
+                for username, customer in legacy.items():
+                    file.write(self.codec.encode(customer))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_filename, self.filename)
+        finally:
+            legacy.close()
+
+    # Streams a customer's orders, oldest first. Customers that are not cached are decoded one order at a
+    # time straight from the account file, so a long history is never materialized.
+    def iter_history(self, username):
+        accounts = self.accounts.shard(username)
+        with accounts.lock:
+            if username in accounts.cache or username in accounts.pending:
+                history = list(accounts[username].history)
+            else:
+                history = None
+                raw = accounts.raw_record(username)
+        if history is not None:
+            yield from history
+        elif raw is not None:
+            yield from self.codec.iter_history(raw)
+
+    # Text form of one account, used by the old account file (see TextAccountCodec).
+    def decode_account(self, line):
+        data = line.split(';')
+        username, password, first_name, last_name, address = data[:5]
+        cart = self.deserialize_cart(data[5])
+        history = self.deserialize_history(data[6:])
+        return Customer(username, password, first_name, last_name, address, cart, history)
+
+    def encode_account(self, customer):
+        cart_data = self.serialize_cart(customer.cart)
+        history_data = self.serialize_history(customer.history)
+        return f"{customer.username};{customer.password};{customer.first_name};{customer.last_name};{customer.address};{cart_data};{history_data}"
+
+    def log_event(self, *event):
+        self.log_events([list(event)])
+
+    def log_events(self, events, sync=False):
+        try:
+            self.accounts.log(*events, sync=sync)
+        except IOError as e:
+            print(f"Error writing account log: {e}")
+
+    # Stock events hold the absolute level after a checkout batch, so replaying one twice is harmless.
+    def apply_catalog_event(self, event):
+        if event[0] == "stock":
+            product = self.products.get(event[1])
+            if product is not None:
+                product.stock = event[2]
+
+    def apply_event(self, customer, event):
+        kind = event[0]
+        if kind == "account":
+            return Customer(*event[1:], ShoppingCart(self.products))
+        elif kind == "cart":
+            product_id, quantity = event[2], event[3]
+            customer.cart.set_quantity(product_id, quantity, self.products.get(product_id))
+        elif kind == "checkout":
+            date, items, total = event[2:]
+            customer.history.append(OrderRecord(date, [item[0] for item in items], [item[1] for item in items], total, self.products))
+            customer.cart.clear_cart()
+        elif kind == "password":
+            customer.password = event[2]
+        return customer
+
+    def record_account(self, customer):
+        self.log_event("account", customer.username, customer.password, customer.first_name, customer.last_name, customer.address)
+
+    def record_cart(self, customer, product):
+        line = customer.cart.items.get(product.id)
+        self.log_event("cart", customer.username, product.id, line.quantity if line else 0)
+
+    def record_checkout(self, customer, record):
+        self.log_events([self.checkout_event(customer, record)])
+
+    def checkout_event(self, customer, record):
+        items = [[product_id, quantity] for product_id, quantity in zip(record.product_ids, record.quantities)]
+        return ["checkout", customer.username, record.date, items, record.total]
+
+    # The files a startup snapshot depends on, with their fingerprints.
+    def snapshot_sources(self):
+        count = ShardedAccountStore.read_count(self.filename)
+        filenames = [self.product_filename, self.pricing_filename, ShardedAccountStore.manifest_filename(self.filename)]
+        for index in range(count):
+            filename = ShardedAccountStore.shard_filename(self.filename, count, index)
+            filenames += [filename, filename + ".log"]
+        return {filename: StartupSnapshot.fingerprint(filename) for filename in filenames}
+
+    def save_snapshot(self):
+        state = self.products.snapshot_state()
+        if state is None:
+            return
+        try:
+            self.snapshot.write(self.snapshot_sources(), state, self.accounts.cached(), self.products)
+        except (IOError, pickle.PicklingError) as e:
+            print(f"Error saving startup snapshot: {e}")
+
+    def close(self):
+        self.accounts.close()
+        if self.snapshot is not None:
+            self.save_snapshot()
+        self.products.close()
+
     def serialize_cart(self, cart):
-        return ','.join([f"{item['product'].id}:{item['quantity']}" for item in cart.items.values()])
+        return ','.join([f"{product_id}:{line.quantity}" for product_id, line in cart.items.items()])
 
     def deserialize_cart(self, cart_data):
-        cart = ShoppingCart()
+        cart = ShoppingCart(self.products)
         if cart_data:
             items = cart_data.split(',')
             for item in items:
                 product_id, quantity = map(int, item.split(':'))
-                cart.items[product_id] = {'product': next((p for p in self.products if p.id == product_id), None), 'quantity': quantity}
+                cart.items[product_id] = CartLine(self.products.get(product_id), quantity)
         return cart
 
     def serialize_history(self, history):
         serialized_records = []
         for record in history:
-            items_str = ",".join([f"{item['product'].id}:{item['quantity']}" for item in record['items'].values()])
-            serialized_record = f"{record['date']}|{items_str}|{record['total']}"
+            items_str = ",".join([f"{product_id}:{quantity}" for product_id, quantity in zip(record.product_ids, record.quantities)])
+            serialized_record = f"{record.date}|{items_str}|{record.total}"
             serialized_records.append(serialized_record)
         return ';'.join(serialized_records)
 
     def deserialize_history(self, history_data):
-        history = []
+        history = PurchaseHistory(self.products)
         for record in history_data:
             if not record:
                 return history
             else:
                 date, items, total = record.split('|')
-                items_dict = {}
+                product_ids = []
+                quantities = []
                 for item in items.split(','):
                     product_id, quantity = map(int, item.split(':'))
-                    items_dict[product_id] = {'product': next((p for p in self.products if p.id == product_id), None), 'quantity': quantity}
-                history.append({'date': date, 'items': items_dict, 'total': float(total)})
+                    product_ids.append(product_id)
+                    quantities.append(quantity)
+                history.append(OrderRecord(date, product_ids, quantities, float(total), self.products))
         return history
 
     def create_account(self):
@@ -268,14 +2655,31 @@ class AccountManager:
                 print("Invalid address, Can't be left empty.")
                 return None
 
-            customer = Customer(username, password, first_name, last_name, address)
-            self.accounts[username] = customer
-            self.save_accounts()
-            print("Account created successfully.")
-            return customer
+            return self.register(username, password, first_name, last_name, address)
         except Exception as e:
             print(f"Error creating account: {e}")
 
+    # Non-interactive sign-up (used by create_account and the server); checks and creates under one lock.
+    # Only the salted hash of the password is kept (see Credentials); it is computed outside the lock.
+    def register(self, username, password, first_name, last_name, address):
+        for label, value in (("username", username), ("password", password), ("first name", first_name), ("last name", last_name), ("address", address)):
+            if not value:
+                print(f"Invalid {label}, Can't be left empty.")
+                return None
+        if username in self.accounts:
+            print("Account already exists.")
+            return None
+        password = credentials.submit_hash(password).result()
+        with self.accounts.shard(username).lock:
+            if username in self.accounts:
+                print("Account already exists.")
+                return None
+            customer = Customer(username, password, first_name, last_name, address, ShoppingCart(self.products))
+            self.accounts[username] = customer
+            self.record_account(customer)
+        print("Account created successfully.")
+        return customer
+
     def login(self):
         try:
             username = input("Enter username: ").strip()
@@ -284,19 +2688,748 @@ class AccountManager:
                 return None
 
             password = input("Enter password: ").strip()
-            if self.accounts[username].password == password:
-                print(f"Login successful as {username}.")
-                return self.accounts[username]
-            else:
-                print("Incorrect password.")
-                return None
+            return self.authenticate(username, password)
         except Exception as e:
             print(f"Error during login: {e}")
             return None
 
+    # A password stored in plain text, or hashed at another cost, is re-hashed after a successful login.
+    def authenticate(self, username, password):
+        customer = self.accounts.get(username)
+        if customer is None:
+            print("Account does not exist.")
+            return None
+        try:
+            verified = credentials.verify(username, customer.password, password)
+        except ShoppingCartException as e:
+            print(e)
+            return None
+        if verified:
+            if credentials.needs_rehash(customer.password):
+                customer.password = credentials.submit_hash(password).result()
+                self.log_event("password", username, customer.password)
+            print(f"Login successful as {username}.")
+            return customer
+        print("Incorrect password.")
+        return None
+
+#Checks out many carts as one batch: stock for the whole batch is reserved under one lock, carts that
+#would oversell are rejected as a whole, and the accepted orders plus the new stock levels are
+#group-committed to the account log in a single write and fsync.
+class CheckoutPipeline:
+    def __init__(self, account_manager):
+        self.account_manager = account_manager
+        self.lock = threading.Lock()
+
+    # Returns one (order record or None, message) pair per customer, in the same order.
+    def process(self, customers):
+        results = []
+        events = []
+        with self.lock:
+            levels = {}
+            orders, dropped = [], []
+            products = self.account_manager.products
+            for customer in customers:
+                lines = customer.cart.items
+                if not lines:
+                    results.append((None, "Your cart is empty! Can't checkout."))
+                    continue
+                # Each line is checked against the catalog's product for its id, which holds the current stock.
+                current = {product_id: products.get(product_id) for product_id in lines}
+                gone = [product_id for product_id, line in lines.items() if line.product is None or current[product_id] is None]
+                if gone:
+                    # Those lines can't be bought (or removed from the menu) any more, so they are dropped with the rejection.
+                    for product_id in gone:
+                        dropped.append((customer, product_id))
+                        events.append(["cart", customer.username, product_id, 0])
+                    names = [lines[product_id].product.name if lines[product_id].product is not None else f"#{product_id}" for product_id in gone]
+                    results.append((None, f"Checkout rejected, no longer in store: {', '.join(names)}. They were taken out of your cart."))
+                    continue
+                short = [product.name for product_id, product in current.items()
+                         if product.stock is not None and levels.get(product_id, product.stock) < lines[product_id].quantity]
+                if short:
+                    results.append((None, f"Checkout rejected, not enough stock for: {', '.join(short)}"))
+                    continue
+                for product_id, product in current.items():
+                    if product.stock is not None:
+                        levels[product_id] = levels.get(product_id, product.stock) - lines[product_id].quantity
+                record = customer.prepare_order()
+                orders.append((customer, record))
+                events.append(self.account_manager.checkout_event(customer, record))
+                results.append((record, f"Checked out successfully.\nYour Total Bill: Rs.{record.total}"))
+            # Nothing changes in memory until the batch is in the log.
+            if events:
+                events.extend(["stock", product_id, level] for product_id, level in levels.items())
+                try:
+                    self.account_manager.accounts.log(*events, sync=True)
+                except IOError as e:
+                    print(f"Error writing account log: {e}")
+                    return [(None, "Checkout failed, please try again.") if record is not None else (record, message)
+                            for record, message in results]
+                for customer, record in orders:
+                    customer.commit_order(record)
+                for customer, product_id in dropped:
+                    with customer.lock:
+                        customer.cart.set_quantity(product_id, 0)
+                for product_id, level in levels.items():
+                    product = products.get(product_id)
+                    if product is not None:
+                        product.stock = level
+        return results
+
+#This class serves the account shards from several processes. Each worker process opens only its own shards
+#(shard i belongs to worker i % workers) and a read-only view of the catalog, so workers never share a file or
+#a lock. Requests are routed by username hash and sent to each worker in one batch, and the workers run in
+#parallel. While the pool runs, this process must not open the same account files.
+class AccountWorkerPool:
+    def __init__(self, filename="User_data.dat", workers=None, product_filename="product_data.bin", shards=None):
+        # Opening the store once here runs any migration or rebalance before the workers start.
+        account_manager = AccountManager(filename=filename, product_filename=product_filename, shards=shards)
+        self.count = account_manager.accounts.count
+        account_manager.close()
+        self.workers = max(1, min(workers or os.cpu_count() or 1, self.count))
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        self.connections = []
+        self.processes = []
+        for worker in range(self.workers):
+            connection, child = context.Pipe()
+            owned = [index for index in range(self.count) if index % self.workers == worker]
+            process = context.Process(target=self.serve, args=(child, filename, product_filename, owned), daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def worker_for(self, username):
+        return username_hash(username) % self.count % self.workers
+
+    # Runs one operation ("authenticate", "register" or "summary") for many requests, each starting with a
+    # username. Results come back in request order.
+    def map(self, operation, requests):
+        batches = [[] for worker in range(self.workers)]
+        positions = [[] for worker in range(self.workers)]
+        for position, request in enumerate(requests):
+            worker = self.worker_for(request[0])
+            batches[worker].append(request)
+            positions[worker].append(position)
+        for worker, batch in enumerate(batches):
+            if batch:
+                self.connections[worker].send((operation, batch))
+        results = [None] * len(requests)
+        for worker, batch in enumerate(batches):
+            if batch:
+                reply = self.connections[worker].recv()
+                if isinstance(reply, Exception):
+                    raise reply
+                for position, result in zip(positions[worker], reply):
+                    results[position] = result
+        return results
+
+    def call(self, operation, *request):
+        return self.map(operation, [request])[0]
+
+    def save(self):
+        for connection in self.connections:
+            connection.send(("save", [()]))
+        for connection in self.connections:
+            connection.recv()
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+        for process, connection in zip(self.processes, self.connections):
+            process.join()
+            connection.close()
+
+    # Body of a worker process: answers batches until it receives None, then closes its shards.
+    @staticmethod
+    def serve(connection, filename, product_filename, owned):
+        sys.stdout = open(os.devnull, 'w')
+        account_manager = AccountManager(filename=filename, product_filename=product_filename, owned=owned)
+
+        def summary(username):
+            customer = account_manager.accounts.get(username)
+            return None if customer is None else (len(customer.history), customer.history.spent)
+
+        operations = {
+            "authenticate": lambda username, password: account_manager.authenticate(username, password) is not None,
+            "register": lambda *fields: account_manager.register(*fields) is not None,
+            "summary": summary,
+            "save": account_manager.save_accounts,
+        }
+        try:
+            while True:
+                request = connection.recv()
+                if request is None:
+                    break
+                operation, batch = request
+                try:
+                    reply = [operations[operation](*arguments) for arguments in batch]
+                except Exception as e:
+                    reply = e
+                connection.send(reply)
+        finally:
+            account_manager.close()
+            connection.close()
+
+#Columnar, NumPy-backed view of every order in the store, for aggregate sales questions.
+#Order-level columns hold one entry per checkout; line-level columns one entry per product in an order.
+#Line revenue uses the product's current price (like view_history); per-day totals use the billed order totals.
+class SalesAnalytics:
+    def __init__(self, usernames, order_dates, order_users, order_totals, line_orders, line_products, line_quantities, line_prices, catalog=None):
+        self.usernames = usernames
+        self.order_dates = order_dates
+        self.order_users = order_users
+        self.order_totals = order_totals
+        self.line_orders = line_orders
+        self.line_products = line_products
+        self.line_quantities = line_quantities
+        self.line_prices = line_prices
+        self.line_revenue = line_quantities * line_prices
+        self.catalog = catalog
+        self._groups = {}
+
+    @classmethod
+    def from_accounts(cls, account_manager):
+        if np is None:
+            raise ShoppingCartException("Sales analytics need NumPy (pip install numpy).")
+        usernames, dates = [], []
+        order_users, order_totals, order_lengths = array('q'), array('d'), array('q')
+        product_ids, quantities = array('q'), array('q')
+        for username, customer in account_manager.accounts.items():
+            user = len(usernames)
+            usernames.append(username)
+            history = customer.history
+            dates.extend(history.dates)
+            order_users.extend([user] * len(history))
+            order_totals.extend(history.totals)
+            order_lengths.extend(end - start for start, end in zip(history.offsets, history.offsets[1:]))
+            product_ids.extend(history.product_ids)
+            quantities.extend(history.quantities)
+        line_products = np.frombuffer(product_ids, dtype=np.int64)
+        # One catalog lookup per distinct product, then a vectorized gather back onto the lines.
+        unique_ids, inverse = np.unique(line_products, return_inverse=True)
+        prices = np.array([product.price if product else 0.0 for product in map(account_manager.products.get, unique_ids.tolist())], dtype=np.float64)
+        return cls(usernames,
+                   np.array(dates, dtype='datetime64[s]'),
+                   np.frombuffer(order_users, dtype=np.int64),
+                   np.frombuffer(order_totals, dtype=np.float64),
+                   np.repeat(np.arange(len(order_lengths)), np.frombuffer(order_lengths, dtype=np.int64)),
+                   line_products,
+                   np.frombuffer(quantities, dtype=np.int64).astype(np.float64),
+                   prices[inverse],
+                   account_manager.products)
+
+    # Maps a key column to group codes once and caches it. Dense integer keys (ids, users, days) are
+    # offset straight into bincount slots; anything else goes through a sort-based np.unique.
+    def _group(self, name, keys):
+        group = self._groups.get(name)
+        if group is None:
+            values = keys.view(np.int64) if keys.dtype.kind == 'M' else keys
+            if len(values) and values.dtype.kind in 'iu' and int(values.max()) - int(values.min()) <= max(len(values), 1 << 20):
+                low = int(values.min())
+                codes = (values - low).astype(np.intp)
+                counts = np.bincount(codes)
+                present = np.flatnonzero(counts)
+                unique_keys = (present + low).astype(values.dtype).view(keys.dtype)
+            else:
+                unique_keys, codes = np.unique(keys, return_inverse=True)
+                present = None
+            group = self._groups[name] = (unique_keys, codes, present)
+        return group
+
+    # Sums "values" per distinct key; returns (keys, sums) sorted by the sums, largest first.
+    def _group_sum(self, name, keys, values, top=None):
+        unique_keys, codes, present = self._group(name, keys)
+        sums = np.bincount(codes, weights=values)
+        if present is not None:
+            sums = sums[present]
+        order = np.argsort(sums, kind='stable')[::-1]
+        if top is not None:
+            order = order[:top]
+        return unique_keys[order], sums[order]
+
+    def order_count(self):
+        return len(self.order_totals)
+
+    def total_revenue(self):
+        return float(self.order_totals.sum())
+
+    def revenue_by_product(self, top=None):
+        return self._group_sum('product', self.line_products, self.line_revenue, top)
+
+    def units_by_product(self, top=None):
+        return self._group_sum('product', self.line_products, self.line_quantities, top)
+
+    def revenue_by_user(self, top=None):
+        users, sums = self._group_sum('user', self.order_users, self.order_totals, top)
+        return [self.usernames[user] for user in users.tolist()], sums
+
+    def revenue_by_day(self):
+        days, sums = self._group_sum('day', self.order_dates.astype('datetime64[D]'), self.order_totals)
+        order = np.argsort(days)
+        return days[order], sums[order]
+
+    # Units and distinct products per order.
+    def basket_sizes(self):
+        units = np.bincount(self.line_orders, weights=self.line_quantities, minlength=self.order_count())
+        lines = np.bincount(self.line_orders, minlength=self.order_count())
+        return units, lines
+
+    def product_name(self, product_id):
+        product = self.catalog.get(product_id) if self.catalog is not None else None
+        return product.name if product else f"Product #{product_id}"
+
+    def print_report(self, top=5, days=7):
+        if not self.order_count():
+            print("No orders have been placed yet.")
+            return
+        units, lines = self.basket_sizes()
+        print(f"Orders: {self.order_count()}    Revenue: Rs.{self.total_revenue():.2f}")
+        print(f"Basket size: {units.mean():.2f} units / {lines.mean():.2f} products on average (largest: {int(units.max())} units)")
+        print("------------------------------------------")
+        print("Top products by revenue:")
+        for product_id, revenue in zip(*self.revenue_by_product(top)):
+            print(f"  {self.product_name(product_id):<17} Rs.{revenue:.2f}")
+        print("Top products by units sold:")
+        for product_id, sold in zip(*self.units_by_product(top)):
+            print(f"  {self.product_name(product_id):<17} {int(sold)}")
+        print("Top customers by spend:")
+        for username, spent in zip(*self.revenue_by_user(top)):
+            print(f"  {username:<17} Rs.{spent:.2f}")
+        print(f"Revenue for the last {days} days with orders:")
+        for day, revenue in list(zip(*self.revenue_by_day()))[-days:]:
+            print(f"  {day}  Rs.{revenue:.2f}")
+        print("------------------------------------------")
+
+#Stand-in for sys.stdout while the server runs: print() from a worker thread that is running a
+#session's command goes into that command's buffer, everything else reaches the real console.
+class SessionOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def capture(self, function, *args):
+        self.local.buffer = io.StringIO()
+        try:
+            function(*args)
+            return self.local.buffer.getvalue()
+        except Exception as e:
+            return self.local.buffer.getvalue() + f"Error: {e}\n"
+        finally:
+            self.local.buffer = None
+
+#Line-protocol server exposing the customer and admin menus to many concurrent sessions sharing one
+#AccountManager. Each command runs in a worker thread and its printed output is sent back followed by
+#an "END" line. Commands for the same account (and catalog changes) are serialized by asyncio locks.
+#CHECKOUTs from all sessions are queued and handed to the CheckoutPipeline in batches of up to
+#"checkout_batch": while one batch is being committed the next one fills up.
+class StoreServer:
+    HELP = """Commands:
+  SIGNUP <username> <password> <first name> <last name> <address>
+  LOGIN <username> <password>        TOKEN <session token>              LOGOUT
+  ADMIN <username> <password>
+  PRODUCTS [page] [keywords] [price:<low>-<high>] [sort:price|-price|name]
+  CART                               HISTORY [<from date> [<to date>]] [<cursor>]
+  ADD <product id> <quantity>        REMOVE <product id> <quantity>     CHECKOUT     COUPON <code>
+  ADDPRODUCT <id> <price> <name>|<description>[|<stock>]   REMOVEPRODUCT <id>   ANALYTICS   METRICS (admin)
+  PRICE <id> <price>   PROMOTIONS [ADD <rule json> | REMOVE <number> | CATEGORY <name> <json>] (admin)
+  HELP                               QUIT"""
+
+    def __init__(self, account_manager, host="127.0.0.1", port=8765, checkout_batch=256):
+        self.account_manager = account_manager
+        self.host = host
+        self.port = port
+        self.checkout_batch = checkout_batch
+        self.checkout_queue = []
+        self.checkout_task = None
+        self.locks = {}
+        self.output = SessionOutput(sys.stdout)
+        self.commands = {
+            "SIGNUP": self.signup, "LOGIN": self.login, "TOKEN": self.resume, "ADMIN": self.admin_login, "LOGOUT": self.logout,
+            "PRODUCTS": self.view_products, "ADD": self.add_to_cart, "REMOVE": self.remove_from_cart,
+            "CART": self.view_cart, "HISTORY": self.view_history, "COUPON": self.apply_coupon,
+            "PRICE": self.change_price, "PROMOTIONS": self.promotions,
+            "ADDPRODUCT": self.add_product, "REMOVEPRODUCT": self.remove_product, "ANALYTICS": self.analytics, "METRICS": self.metrics,
+            "HELP": lambda session, args: print(self.HELP),
+        }
+
+    # Holds the asyncio lock for "key". Locks are made on first use and dropped when nobody holds or waits
+    # for them any more, so "locks" only has the keys in use right now.
+    @contextlib.asynccontextmanager
+    async def lock_for(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+    # Which lock a command needs: the account it touches, or the catalog for changing products. Listing
+    # products needs none, as the catalog locks its own reads.
+    def lock_key(self, session, command, args):
+        if command in ("SIGNUP", "LOGIN"):
+            return "user:" + args.split(" ", 1)[0]
+        if command in ("ADDPRODUCT", "REMOVEPRODUCT", "PRICE", "PROMOTIONS"):
+            return "catalog"
+        if session["username"]:
+            return "user:" + session["username"]
+        return None
+
+    async def run(self, session, command, args):
+        if command == "CHECKOUT":
+            return await self.checkout(session)
+        function = self.commands.get(command)
+        if function is None:
+            return "Invalid command. Type HELP for the list of commands.\n"
+        loop = asyncio.get_running_loop()
+        key = self.lock_key(session, command, args)
+        if key is None:
+            return await loop.run_in_executor(None, self.output.capture, function, session, args)
+        async with self.lock_for(key):
+            return await loop.run_in_executor(None, self.output.capture, function, session, args)
+
+    async def checkout(self, session):
+        if not session["username"]:
+            return "Error: Log in as a customer first.\n"
+        loop = asyncio.get_running_loop()
+        async with self.lock_for("user:" + session["username"]):
+            customer = await loop.run_in_executor(None, self.account_manager.accounts.__getitem__, session["username"])
+            future = loop.create_future()
+            self.checkout_queue.append((customer, future))
+            if self.checkout_task is None:
+                self.checkout_task = asyncio.ensure_future(self.flush_checkouts())
+            record, message = await future
+        return message + "\n"
+
+    async def flush_checkouts(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.checkout_queue:
+                batch = self.checkout_queue[:self.checkout_batch]
+                del self.checkout_queue[:self.checkout_batch]
+                try:
+                    results = await loop.run_in_executor(None, self.account_manager.checkouts.process, [customer for customer, future in batch])
+                except Exception as e:
+                    results = [(None, f"Error: {e}")] * len(batch)
+                for (customer, future), result in zip(batch, results):
+                    future.set_result(result)
+        finally:
+            self.checkout_task = None
+
+    async def handle(self, reader, writer):
+        session = {"username": None, "admin": None, "token": None}
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command, _, args = line.decode("utf-8", "replace").strip().partition(" ")
+                command = command.upper()
+                if command == "QUIT":
+                    break
+                output = await self.run(session, command, args.strip())
+                writer.write((output.rstrip("\n") + "\nEND\n").encode("utf-8"))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        sys.stdout = self.output
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print(f"Store server listening on {self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+    # Commands. They run in worker threads and report back through print(), like the menus do.
+    def customer(self, session):
+        if not session["username"]:
+            raise ShoppingCartException("Log in as a customer first.")
+        return self.account_manager.accounts[session["username"]]
+
+    def admin(self, session):
+        if session["admin"] is None:
+            raise ShoppingCartException("Log in as admin first.")
+        return session["admin"]
+
+    def ids_and_quantity(self, args):
+        try:
+            product_id, quantity = map(int, args.split())
+        except ValueError:
+            raise ShoppingCartException("Invalid input. Please enter numeric values for product ID and quantity.")
+        product = self.account_manager.products.get(product_id)
+        if product is None:
+            raise ShoppingCartException("Product not found.")
+        return product, quantity
+
+    def signup(self, session, args):
+        fields = args.split(" ", 4)
+        self.account_manager.register(*(fields + [""] * (5 - len(fields))))
+
+    def login(self, session, args):
+        username, _, password = args.partition(" ")
+        if self.account_manager.authenticate(username, password):
+            self.end_session(session)
+            session["username"], session["token"] = username, credentials.issue(username)
+            print(f"Session token: {session['token']}")
+
+    # Logs a session in again with a token from LOGIN, without checking the password.
+    def resume(self, session, args):
+        username = credentials.resume(args)
+        if username is None or username not in self.account_manager.accounts:
+            raise ShoppingCartException("Invalid or expired session token.")
+        if session["token"] != args:
+            self.end_session(session)
+        session["username"], session["token"] = username, args
+        print(f"Login successful as {username}.")
+
+    def admin_login(self, session, args):
+        username, _, password = args.partition(" ")
+        admin = Admin(admin_username, admin_password, admin_firstname, admin_lastname, admin_address)
+        if admin.login(username, password):
+            self.end_session(session)
+            session["admin"] = admin
+            print("Login successful as Admin!")
+        else:
+            print("Invalid credentials. Access denied.")
+
+    # Forgets who the session is logged in as and revokes its token, so a later TOKEN can't resume it.
+    def end_session(self, session):
+        if session["token"] is not None:
+            credentials.revoke(session["token"])
+        session["username"], session["admin"], session["token"] = None, None, None
+
+    def logout(self, session, args):
+        self.end_session(session)
+        print("Logging out...")
+
+    # PRODUCTS [page] [search]: one page of the catalog, e.g. "PRODUCTS 2 phone price:100-500 sort:price".
+    def view_products(self, session, args):
+        viewer = session["admin"] or self.customer(session)
+        words = args.split()
+        page = max(int(words.pop(0)), 1) if words and words[0].isdigit() else 1
+        try:
+            query = ProductQuery.parse(' '.join(words))
+        except ValueError as e:
+            print(e)
+            return
+        viewer.view_products(self.account_manager.products, page, query)
+
+    def add_to_cart(self, session, args):
+        customer = self.customer(session)
+        product, quantity = self.ids_and_quantity(args)
+        customer.add_to_cart(product, quantity)
+        self.account_manager.record_cart(customer, product)
+
+    def remove_from_cart(self, session, args):
+        customer = self.customer(session)
+        product, quantity = self.ids_and_quantity(args)
+        customer.remove_from_cart(product, quantity)
+        self.account_manager.record_cart(customer, product)
+
+    def view_cart(self, session, args):
+        self.customer(session).view_cart()
+
+    def apply_coupon(self, session, args):
+        self.customer(session).apply_coupon(args)
+
+    # HISTORY [<from date> [<to date>]] [<cursor>]: one page of orders, newest first. Dates may be prefixes
+    # ("2024-07") and a single date is a range of its own; the cursor printed with a page asks for the next, older one.
+    def view_history(self, session, args):
+        dates = [word for word in args.split() if not word.isdigit()][:2]
+        cursors = [int(word) for word in args.split() if word.isdigit()]
+        next_cursor = self.customer(session).view_history(cursors[0] if cursors else None, 10, *(dates * 2)[:2])
+        if next_cursor is not None:
+            print(f"Older orders: HISTORY {' '.join(dates + [str(next_cursor)])}")
+
+    def add_product(self, session, args):
+        admin = self.admin(session)
+        try:
+            product_id, price, rest = args.split(" ", 2)
+            name, _, rest = rest.partition("|")
+            description, _, stock = rest.partition("|")
+            product = Product(int(product_id), name.strip(), float(price), description.strip(), int(stock) if stock.strip() else None)
+        except ValueError:
+            raise ShoppingCartException("Usage: ADDPRODUCT <id> <price> <name>|<description>[|<stock>]")
+        if product.id in self.account_manager.products:
+            raise ShoppingCartException(f"Already a product exists with id: {product.id}")
+        admin.add_product(self.account_manager.products, product)
+        self.account_manager.save_products()
+
+    def remove_product(self, session, args):
+        admin = self.admin(session)
+        try:
+            product_id = int(args)
+        except ValueError:
+            raise ShoppingCartException("Invalid ID. Please enter a numeric value.")
+        if product_id not in self.account_manager.products:
+            raise ShoppingCartException(f"Product does not exist with id: {product_id}")
+        admin.remove_product(self.account_manager.products, product_id)
+        self.account_manager.save_products()
+
+    def change_price(self, session, args):
+        self.admin(session)
+        try:
+            product_id, price = args.split()
+            product = self.account_manager.change_price(int(product_id), float(price))
+        except ValueError:
+            raise ShoppingCartException("Usage: PRICE <id> <price>")
+        print(f"{product.name} now costs Rs.{product.price}.")
+
+    def promotions(self, session, args):
+        self.admin(session)
+        pricing = self.account_manager.products.pricing
+        action, _, rest = args.partition(" ")
+        try:
+            if action.upper() == "ADD":
+                self.account_manager.set_pricing(pricing.rules + [json.loads(rest)])
+            elif action.upper() == "REMOVE":
+                number = int(rest)
+                if not 1 <= number <= len(pricing.rules):
+                    raise ShoppingCartException(f"There is no rule {number}.")
+                self.account_manager.set_pricing(pricing.rules[:number - 1] + pricing.rules[number:])
+            elif action.upper() == "CATEGORY":
+                name, _, category = rest.partition(" ")
+                self.account_manager.set_pricing(pricing.rules, {**pricing.categories, name: json.loads(category)})
+            elif action:
+                raise ShoppingCartException("Usage: PROMOTIONS [ADD <rule json> | REMOVE <number> | CATEGORY <name> <json>]")
+        except ValueError as e:
+            raise ShoppingCartException(str(e))
+        print(pricing.report())
+
+    def analytics(self, session, args):
+        self.admin(session)
+        SalesAnalytics.from_accounts(self.account_manager).print_report()
+
+    def metrics(self, session, args):
+        self.admin(session)
+        print(metrics.report())
+
+#Pages through the catalog in the menus: "n"/"p" move between pages, anything else is a new search
+#(see ProductQuery) and an empty line goes back.
+def browse_products(viewer, products):
+    query = ProductQuery()
+    page = 1
+    while True:
+        more = viewer.view_products(products, page, query)
+        choice = input("n = next page, p = previous page, or type a search (e.g. phone price:100-500 sort:price); Enter to continue: ").strip()
+        if not choice:
+            return
+        elif choice.lower() == "n":
+            if more:
+                page += 1
+            else:
+                print("This is the last page.")
+        elif choice.lower() == "p":
+            if page > 1:
+                page -= 1
+            else:
+                print("This is the first page.")
+        else:
+            try:
+                query = ProductQuery.parse(choice)
+                page = 1
+            except ValueError as e:
+                print(e)
+
+#Pages through a customer's orders, newest first: "n" shows older orders, two dates (or one) limit the
+#orders to a range, e.g. "2024-01-01 2024-06-30" or "2024-07", and an empty line goes back.
+def browse_history(customer):
+    cursor, start, end = None, None, None
+    while True:
+        next_cursor = customer.view_history(cursor, 10, start, end)
+        if not customer.history:
+            return
+        choice = input("n = older orders, or type a date range (e.g. 2024-01-01 2024-06-30); Enter to continue: ").strip()
+        if not choice:
+            return
+        elif choice.lower() == "n":
+            if next_cursor is not None:
+                cursor = next_cursor
+            else:
+                print("There are no older orders.")
+        else:
+            dates = choice.split()
+            start, end = dates[0], dates[1] if len(dates) > 1 else dates[0]
+            cursor = None
+
+#Shows the metrics report in the admin menu and lets the admin switch metrics and the profiler on or off.
+def performance_report():
+    while True:
+        print(metrics.report())
+        choice = input("m = metrics on/off, p = profiler on/off, d = dump to file, r = reset; Enter to go back: ").strip().lower()
+        if not choice:
+            return
+        elif choice == "m" and metrics.enabled:
+            metrics.disable()
+        elif choice == "m":
+            metrics.enable()
+        elif choice == "p" and metrics.profiling:
+            metrics.stop_profiler()
+        elif choice == "p":
+            metrics.start_profiler()
+        elif choice == "d":
+            try:
+                print(f"Metrics written to {metrics.dump()}")
+            except IOError as e:
+                print(f"Error writing metrics: {e}")
+        elif choice == "r":
+            metrics.reset()
+        else:
+            print("Invalid choice.")
+
+#Lets the admin edit the promotion rules (see PricingEngine) and product prices from the menu.
+def manage_pricing(account_manager):
+    pricing = account_manager.products.pricing
+    while True:
+        print(pricing.report())
+        choice = input("a = add rule, r = remove rule, c = set category, p = change a price; Enter to go back: ").strip().lower()
+        try:
+            if not choice:
+                return
+            elif choice == "a":
+                rule = json.loads(input('Enter the rule, e.g. {"type": "percent", "percent": 10, "products": [1, 2]}: '))
+                account_manager.set_pricing(pricing.rules + [rule])
+            elif choice == "r":
+                number = int(input("Enter rule number to remove: ").strip())
+                if not 1 <= number <= len(pricing.rules):
+                    print(f"There is no rule {number}.")
+                    continue
+                account_manager.set_pricing(pricing.rules[:number - 1] + pricing.rules[number:])
+            elif choice == "c":
+                name = input("Enter category name: ").strip()
+                category = json.loads(input('Enter the category, e.g. {"ids": [1, 2], "keywords": ["phone"]}: '))
+                account_manager.set_pricing(pricing.rules, {**pricing.categories, name: category})
+            elif choice == "p":
+                product_id = int(input("Enter product ID: ").strip())
+                price = float(input("Enter the new price: ").strip())
+                product = account_manager.change_price(product_id, price)
+                print(f"{product.name} now costs Rs.{product.price}.")
+            else:
+                print("Invalid choice.")
+        except ValueError as e:
+            print(e)
+        except ShoppingCartException as e:
+            print(e)
+
 #Demonstrates the usage of these classes to manage an online shopping cart.
-def main():
-    account_manager = AccountManager()
+def main(snapshot=False):
+    account_manager = AccountManager(snapshot=snapshot)
     products = account_manager.products
     while True:
         # Welcome statement (Interface)
@@ -320,18 +3453,20 @@ def main():
                     print("1. View Products")
                     print("2. Add Product")
                     print("3. Remove Product")
-                    print("4. Logout")
+                    print("4. Sales Analytics")
+                    print("5. Performance Report")
+                    print("6. Promotions and Prices")
+                    print("7. Logout")
                     admin_choice = input("Enter your choice: ").strip()
-                    products_id = [product.id for product in products]
                     if admin_choice == "1":
                         print(f"\n\t\t\t\t\t\t-----\"Product Catalog\"-----\n")
-                        admin.view_products(products)
+                        browse_products(admin, products)
                     elif admin_choice == "2":
                         print(f"\n\t----\"Add Product In Store\"----\t\n")
                         while True:
                             try:
                                 id = int(input("Enter product ID: ").strip())
-                                if id in products_id:
+                                if id in products:
                                     print(f"Already a product exists with id: {id}")
                                 else:
                                     break
@@ -344,7 +3479,13 @@ def main():
                             print("Invalid price. Please enter a numeric value.")
                             continue
                         description = input("Enter product description: ").strip()
-                        new_product = Product(id, name, price, description)
+                        try:
+                            stock = input("Enter stock (leave empty for unlimited): ").strip()
+                            stock = int(stock) if stock else None
+                        except ValueError:
+                            print("Invalid stock. Please enter a whole number.")
+                            continue
+                        new_product = Product(id, name, price, description, stock)
                         admin.add_product(products, new_product)
                         account_manager.save_products()
                     elif admin_choice == "3":
@@ -352,7 +3493,7 @@ def main():
                         while True:
                             try:
                                 product_id = int(input("Enter product ID to remove: ").strip())
-                                if product_id not in products_id:
+                                if product_id not in products:
                                     print(f"Product does not exist with id: {product_id}")
                                 else:
                                     break
@@ -361,6 +3502,18 @@ def main():
                         admin.remove_product(products, product_id)
                         account_manager.save_products()
                     elif admin_choice == "4":
+                        print(f"\n\t\t----\"Sales Analytics\"----\t\t\n")
+                        try:
+                            SalesAnalytics.from_accounts(account_manager).print_report()
+                        except ShoppingCartException as e:
+                            print(e)
+                    elif admin_choice == "5":
+                        print(f"\n\t\t----\"Performance Report\"----\t\t\n")
+                        performance_report()
+                    elif admin_choice == "6":
+                        print(f"\n\t\t----\"Promotions and Prices\"----\t\t\n")
+                        manage_pricing(account_manager)
+                    elif admin_choice == "7":
                         print("Logging out...")
                         break
                     else:
@@ -383,36 +3536,36 @@ def main():
                     if customer:
                         while True:
                             print("\n\t\t----\"Customer Menu\"----\t\t\t\n")
-                            print("1. View Products\n2. Add to Cart\n3. Remove from Cart\n4. View Cart\n5. Checkout\n6. View History\n7. Logout")
+                            print("1. View Products\n2. Add to Cart\n3. Remove from Cart\n4. View Cart\n5. Checkout\n6. View History\n7. Apply Coupon\n8. Logout")
                             user_choice = input("Enter choice: ").strip()
 
                             if user_choice == '1':
                                 print("\n\t\t\t\t\t\t-----\"Product Catalog\"-----\t\n")
-                                customer.view_products(products)
+                                browse_products(customer, products)
                             elif user_choice == '2':
                                 print(f"\n\t\t\t\t\t----\"Add Product To Cart\"----\t\n")
-                                customer.view_products(products)
+                                browse_products(customer, products)
                                 try:
                                     product_id = int(input("Enter product ID to add to cart: ").strip())
                                     quantity = int(input("Enter quantity: ").strip())
-                                    product = next((p for p in products if p.id == product_id), None)
+                                    product = products.get(product_id)
                                     if product:
                                         customer.add_to_cart(product, quantity)
-                                        account_manager.save_accounts()
+                                        account_manager.record_cart(customer, product)
                                     else:
                                         print("Product not found.")
                                 except ValueError:
                                     print("Invalid input. Please enter numeric values for product ID and quantity.")
                             elif user_choice == '3':
                                 print(f"\n\t\t\t\t\t----\"Remove Product From Cart\"----\t\n")
-                                customer.view_products(products)
+                                customer.view_cart()
                                 try:
                                     product_id = int(input("Enter product ID to remove from cart: ").strip())
                                     quantity = int(input("Enter quantity: ").strip())
-                                    product = next((p for p in products if p.id == product_id), None)
+                                    product = products.get(product_id)
                                     if product:
                                         customer.remove_from_cart(product, quantity)
-                                        account_manager.save_accounts()
+                                        account_manager.record_cart(customer, product)
                                     else:
                                         print("Product not found.")
                                 except ValueError:
@@ -422,12 +3575,14 @@ def main():
                                 customer.view_cart()
                             elif user_choice == '5':
                                 print(f"\n\t\t\t----\"Checkout\"----\t\t\t\n")
-                                customer.checkout()
-                                account_manager.save_accounts()
+                                record, message = account_manager.checkouts.process([customer])[0]
+                                print(message)
                             elif user_choice == '6':
                                 print(f"\n\t\t----\"Your Shopping History\"----\t\t\t\n")
-                                customer.view_history()
+                                browse_history(customer)
                             elif user_choice == '7':
+                                customer.apply_coupon(input("Enter coupon code: "))
+                            elif user_choice == '8':
                                 print("Logging out...")
                                 break
                             else:
@@ -437,9 +3592,47 @@ def main():
                 else:
                     print("Invalid choice.")
         elif choice == "3":
+            account_manager.close()
             break
         else:
             print("Invalid choice.")
 
+#Runs the store as a network server instead of the interactive menu.
+def serve(host, port, snapshot=False):
+    account_manager = AccountManager(snapshot=snapshot)
+    try:
+        asyncio.run(StoreServer(account_manager, host, port).serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout = sys.__stdout__
+        account_manager.close()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Online Electronic Devices Store")
+    parser.add_argument("--serve", action="store_true", help="serve many sessions over a line protocol instead of the menu")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rebalance", type=int, metavar="SHARDS", help="split the accounts into SHARDS shard files and exit")
+    parser.add_argument("--metrics", action="store_true", help="time the store's operations and write metrics.json on exit")
+    parser.add_argument("--profile", action="store_true", help="like --metrics, and also run the sampling profiler")
+    parser.add_argument("--snapshot", action="store_true", help="start from (and on exit save) a snapshot of the loaded store")
+    parser.add_argument("--hash-iterations", type=int, default=credentials.iterations, help="PBKDF2 cost of new password hashes")
+    parser.add_argument("--hash-password", action="store_true", help="print the hash of a password (e.g. for admin_password) and exit")
+    args = parser.parse_args()
+    credentials.iterations = args.hash_iterations
+    if args.metrics or args.profile:
+        metrics.enable()
+    if args.profile:
+        metrics.start_profiler()
+    if args.hash_password:
+        print(credentials.hash(input("Enter password: ").strip()))
+    elif args.rebalance is not None:
+        AccountManager(shards=args.rebalance).close()
+    elif args.serve:
+        serve(args.host, args.port, args.snapshot)
+    else:
+        main(args.snapshot)
+    if metrics.enabled:
+        metrics.stop_profiler()
+        print(f"Metrics written to {metrics.dump()}")
\ No newline at end of file
@@ -0,0 +1,983 @@
+#Benchmarks for "Final code.py". They drive the classes directly, never through input().
+#Usage: python benchmark.py suite [--products 1000] [--users 2000] [--history 20] [--output FILE]
+#                                 [--baseline FILE] [--save-baseline FILE] [--tolerance 0.2]
+#       python benchmark.py catalog [--sizes 10000 100000 1000000]
+#       python benchmark.py memory [--count 100000] [--lines 3]
+#       python benchmark.py analytics [--lines 10000000]   (needs NumPy)
+#       python benchmark.py loadgen [--sessions 50] [--requests 200] [--host HOST --port PORT]
+#       python benchmark.py flashsale [--carts 2000] [--history 20] [--batches 1 16 256]
+#       python benchmark.py codecs [--users 200] [--history 20 2000]
+#       python benchmark.py search [--size 1000000]
+#       python benchmark.py history [--orders 100000]
+#       python benchmark.py shards [--users 20000] [--shards 8] [--workers 1 2 4 8] [--logins 20000]
+#       python benchmark.py metrics [--users 2000]
+#       python benchmark.py startup [--products 1000000] [--users 100000] [--runs 3]
+#       python benchmark.py logins [--iterations 100000 200000 600000] [--workers 1 2 4] [--logins 24]
+#       python benchmark.py pricing [--lines 10 100 1000] [--rules 200]
+import argparse
+import asyncio
+import contextlib
+import gc
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STORE_PATH = os.path.join(HERE, "Final code.py")
+
+
+#"Final code.py" has a space in its name, so it is loaded from its path instead of imported.
+def load_store():
+    spec = importlib.util.spec_from_file_location("store", STORE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+#Runs a snippet in a new interpreter with the store loaded as "store"; the snippet leaves its
+#measurements in a dict called "result", which is returned together with the child's peak RSS.
+CHILD_PRELUDE = f"""
+import json, sys, time
+sys.path.insert(0, {HERE!r})
+from benchmark import load_store, peak_rss_kb
+store = load_store()
+result = {{}}
+"""
+
+def run_child(code, cwd):
+    output = subprocess.run([sys.executable, "-c", CHILD_PRELUDE + code + "\nresult['peak_rss_kb'] = peak_rss_kb()\nprint(json.dumps(result))"],
+                            cwd=cwd, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def generate_products(store, count, seed=1):
+    rng = random.Random(seed)
+    words = ["Laptop", "Phone", "Cable", "Charger", "Speaker", "Monitor", "Camera", "Router", "Drive", "Watch"]
+    return [store.Product(i, f"{rng.choice(words)} {i}", rng.choice([rng.randint(100, 90000), round(rng.uniform(100, 90000), 2)]),
+                          f"{rng.choice(words)} accessory number {i}") for i in range(1, count + 1)]
+
+
+#Synthetic store for the suite: "products" products, "users" customers with "history" past orders
+#each (1-5 lines) and a 3-line cart, written straight into User_data.dat / product_data.bin in "workdir".
+#"password" is stored as given: plain "pw" by default, or a hash from store.credentials.hash("pw").
+def generate_customers(store, catalog, products, users, history, seed=1, password="pw"):
+    rng = random.Random(seed)
+    for i in range(users):
+        customer = store.Customer(f"user{i}", password, "First", "Last", f"{i} Main Street", store.ShoppingCart(catalog))
+        for j in range(history):
+            count = rng.randint(1, 5)
+            customer.history.append(store.OrderRecord(f"2024-{rng.randint(1, 12):02}-{rng.randint(1, 28):02} 10:00:00",
+                                                      rng.sample(range(1, products + 1), count), [rng.randint(1, 3) for _ in range(count)],
+                                                      float(rng.randint(100, 200000)), catalog))
+        for product_id in rng.sample(range(1, products + 1), 3):
+            customer.cart.add_product(catalog.get(product_id), 1)
+        yield customer
+
+
+def generate_store(store, workdir, products, users, history, seed=1, password="pw"):
+    catalog = store.ProductCatalog(generate_products(store, products, seed))
+    catalog.save_binary(os.path.join(workdir, "product_data.bin"))
+    codec = store.BinaryAccountCodec(catalog)
+    with contextlib.redirect_stdout(io.StringIO()), open(os.path.join(workdir, "User_data.dat"), "wb") as f:
+        for customer in generate_customers(store, catalog, products, users, history, seed, password):
+            f.write(codec.encode(customer))
+
+
+#Times "operation(i)" over "rounds" rounds of "repeat" calls with the garbage collector off (like timeit)
+#and keeps the fastest round's throughput; latency percentiles cover every call. A second, shorter pass
+#under tracemalloc gives the peak Python memory the operation needs.
+def measure(operation, repeat, memory_repeat=None, rounds=3):
+    latencies = []
+    best = None
+    calls = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for _ in range(rounds):
+                start = time.perf_counter()
+                for i in range(calls, calls + repeat):
+                    began = time.perf_counter_ns()
+                    operation(i)
+                    latencies.append(time.perf_counter_ns() - began)
+                elapsed = time.perf_counter() - start
+                calls += repeat
+                best = elapsed if best is None else min(best, elapsed)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        tracemalloc.start()
+        for i in range(calls, calls + (memory_repeat if memory_repeat is not None else min(repeat, 50))):
+            operation(i)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    latencies.sort()
+    return {
+        "ops": repeat,
+        "ops_per_sec": repeat / best if best else float("inf"),
+        "p50_us": percentile(latencies, 0.50) / 1000,
+        "p95_us": percentile(latencies, 0.95) / 1000,
+        "p99_us": percentile(latencies, 0.99) / 1000,
+        "peak_kb": peak / 1024,
+    }
+
+
+def run_suite(products, users, history, seed=1):
+    store = load_store()
+    home = os.getcwd()
+    results = {}
+    workdir = tempfile.mkdtemp()
+    try:
+        generate_store(store, workdir, products, users, history, seed)
+        os.chdir(workdir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager = store.AccountManager()
+        catalog = manager.products
+        rng = random.Random(seed)
+        codec = manager.codec
+        records = [manager.accounts.raw_record(f"user{i}") for i in range(min(users, 200))]
+        customers = [codec.decode(raw) for raw in records]
+        sample_products = [catalog.get(rng.randint(1, products)) for _ in range(64)]
+
+        def load_accounts(i):
+            store.AccountManager(cache_size=manager.cache_size).close()
+
+        def login_cold(i):
+            username = f"user{i % users}"
+            manager.accounts.shard(username).cache.clear()
+            manager.accounts[username]
+
+        def cart_add_remove(i):
+            cart = customers[i % len(customers)].cart
+            product = sample_products[i % len(sample_products)]
+            cart.add_product(product, 2)
+            cart.remove_product(product, 2)
+
+        def checkout(i):
+            customer = customers[i % len(customers)]
+            for product in sample_products[i % 61:i % 61 + 3]:
+                customer.add_to_cart(product, 1)
+            customer.checkout()
+            customer.history.pop()
+
+        def pipeline_checkout(i):
+            customer = manager.accounts[f"user{i % users}"]
+            for product in sample_products[i % 61:i % 61 + 3]:
+                customer.add_to_cart(product, 1)
+            manager.checkouts.process([customer])
+
+        def save_accounts(i):
+            for j in range(100):
+                username = f"user{(i * 100 + j) % users}"
+                manager.accounts.shard(username).dirty.add(username)
+            manager.save_accounts()
+
+        cases = {
+            "load_accounts": (load_accounts, 5, 1),
+            "login_cold": (login_cold, 2000, None),
+            "encode_account": (lambda i: codec.encode(customers[i % len(customers)]), 2000, None),
+            "decode_account": (lambda i: codec.decode(records[i % len(records)]), 2000, None),
+            "stream_history": (lambda i: sum(1 for _ in codec.iter_history(records[i % len(records)])), 2000, None),
+            "cart_add_remove": (cart_add_remove, 20000, None),
+            "calculate_total": (lambda i: customers[i % len(customers)].cart.calculate_total(), 20000, None),
+            "checkout": (checkout, 5000, None),
+            "pipeline_checkout": (pipeline_checkout, 2000, None),
+            "save_accounts": (save_accounts, 5, 1),
+        }
+        for name, (operation, repeat, memory_repeat) in cases.items():
+            results[name] = measure(operation, repeat, memory_repeat)
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager.close()
+    finally:
+        os.chdir(home)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "meta": {"products": products, "users": users, "history": history, "seed": seed,
+                 "python": platform.python_version(), "platform": platform.platform(),
+                 "date": time.strftime("%Y-%m-%d %H:%M:%S")},
+        "results": results,
+    }
+
+
+#A case regresses when its throughput drops by more than "tolerance" (0.2 = 20%) against the baseline.
+def compare(report, baseline, tolerance):
+    regressions = []
+    print(f"{'case':<20} | {'ops/sec':>12} | {'baseline':>12} | {'change':>8}")
+    for name, result in report["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<20} | {result['ops_per_sec']:>12,.0f} | {'-':>12} | {'new':>8}")
+            continue
+        change = result["ops_per_sec"] / base["ops_per_sec"] - 1
+        flag = "  REGRESSION" if change < -tolerance else ""
+        print(f"{name:<20} | {result['ops_per_sec']:>12,.0f} | {base['ops_per_sec']:>12,.0f} | {change:>+7.1%}{flag}")
+        if flag:
+            regressions.append(name)
+    if baseline["meta"].get("users") != report["meta"]["users"] or baseline["meta"].get("history") != report["meta"]["history"]:
+        print("Note: the baseline was recorded with a different data set size.")
+    return regressions
+
+
+def bench_suite(products, users, history, output, baseline_file, save_baseline, tolerance):
+    report = run_suite(products, users, history)
+    print(f"{products} products, {users} users, {history} orders per user")
+    print(f"{'case':<20} | {'ops/sec':>12} | {'p50 (us)':>10} | {'p95 (us)':>10} | {'p99 (us)':>10} | {'peak (KB)':>10}")
+    for name, result in report["results"].items():
+        print(f"{name:<20} | {result['ops_per_sec']:>12,.0f} | {result['p50_us']:>10.1f} | {result['p95_us']:>10.1f} | {result['p99_us']:>10.1f} | {result['peak_kb']:>10.1f}")
+    for filename in filter(None, (output, save_baseline)):
+        with open(filename, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {filename}")
+    if baseline_file:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, tolerance)
+        if regressions:
+            sys.exit(f"Regressions against {baseline_file}: {', '.join(regressions)}")
+
+
+def bench_catalog(sizes):
+    print(f"{'products':>10} | {'format':<22} | {'load (s)':>9} | {'peak RSS (MB)':>13}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as workdir:
+            # Linux carries ru_maxrss across fork/exec, so the big data set is built in a child as well.
+            run_child(f"""
+from benchmark import generate_products
+products = generate_products(store, {size})
+with open('product_data.txt', 'w') as f:
+    f.write(str([[p.id, p.name, p.price, p.description] for p in products]))
+store.ProductCatalog(products).save_binary('product_data.bin')
+""", workdir)
+            runs = {
+                "eval (text)": """
+start = time.perf_counter()
+with open('product_data.txt') as f:
+    data = eval(f.read())
+products = [store.Product(item[0], item[1], item[2], item[3]) for item in data]
+result['seconds'] = time.perf_counter() - start
+""",
+                "binary (mmap, lazy)": """
+start = time.perf_counter()
+catalog = store.ProductCatalog()
+catalog.load_binary('product_data.bin')
+result['seconds'] = time.perf_counter() - start
+""",
+                "binary (all loaded)": """
+start = time.perf_counter()
+catalog = store.ProductCatalog()
+catalog.load_binary('product_data.bin')
+for product in catalog:
+    pass
+result['seconds'] = time.perf_counter() - start
+""",
+            }
+            for name, code in runs.items():
+                result = run_child(code, workdir)
+                rss = f"{result['peak_rss_kb'] / 1024:.1f}" if result['peak_rss_kb'] is not None else "n/a"
+                print(f"{size:>10} | {name:<22} | {result['seconds']:>9.3f} | {rss:>13}")
+
+
+#The representations used before Product/User/ShoppingCart got __slots__ and orders became OrderRecords.
+class LegacyProduct:
+    def __init__(self, id, name, price, description):
+        self.id = id
+        self.name = name
+        self.price = price
+        self.description = description
+
+class LegacyCart:
+    def __init__(self):
+        self.items = {}
+
+class LegacyCustomer:
+    def __init__(self, username, password, first_name, last_name, address):
+        self.username = username
+        self.password = password
+        self.first_name = first_name
+        self.last_name = last_name
+        self.address = address
+        self.cart = LegacyCart()
+        self.history = []
+
+
+def measure_bytes(build, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / count
+
+
+def bench_memory(count, lines):
+    store = load_store()
+    catalog = store.ProductCatalog(generate_products(store, 1000))
+    products = list(catalog)
+    picks = [[products[(i * 7 + j * 13) % len(products)] for j in range(lines)] for i in range(64)]
+
+    def legacy_order(i):
+        items = {p.id: {'product': p, 'quantity': j + 1} for j, p in enumerate(picks[i % 64])}
+        return {'date': f"2024-07-{i % 28 + 1:02} 10:00:{i % 60:02}", 'items': items, 'total': 1000.0 + i}
+
+    def slotted_order(i):
+        chosen = picks[i % 64]
+        return store.OrderRecord(f"2024-07-{i % 28 + 1:02} 10:00:{i % 60:02}", [p.id for p in chosen], range(1, len(chosen) + 1), 1000.0 + i, catalog)
+
+    def legacy_user(i):
+        return LegacyCustomer(f"user{i}", "pw", "First", "Last", "Address")
+
+    def slotted_user(i):
+        return store.Customer(f"user{i}", "pw", "First", "Last", "Address", store.ShoppingCart(catalog))
+
+    def legacy_product(i):
+        return LegacyProduct(i, "Name", 100, "Description")
+
+    def slotted_product(i):
+        return store.Product(i, "Name", 100, "Description")
+
+    print(f"{'object':<28} | {'before (bytes)':>14} | {'after (bytes)':>13}")
+    rows = [
+        (f"order ({lines} lines)", legacy_order, slotted_order, count),
+        ("user (empty cart/history)", legacy_user, slotted_user, count),
+        ("product", legacy_product, slotted_product, count),
+    ]
+    for name, before, after, count in rows:
+        print(f"{name:<28} | {measure_bytes(before, count):>14.0f} | {measure_bytes(after, count):>13.0f}")
+
+
+#Builds the analytics columns straight from synthetic data (no accounts involved) and times each query.
+def bench_analytics(line_count, users=100000, products=100000, seed=1):
+    store = load_store()
+    np = store.np
+    if np is None:
+        sys.exit("The analytics benchmark needs NumPy (pip install numpy).")
+    rng = np.random.default_rng(seed)
+    order_count = line_count // 3
+    line_orders = np.sort(rng.integers(0, order_count, line_count))
+    line_products = rng.integers(1, products + 1, line_count)
+    line_quantities = rng.integers(1, 5, line_count).astype(np.float64)
+    line_prices = rng.integers(100, 90000, products + 1).astype(np.float64)[line_products]
+    order_totals = np.bincount(line_orders, weights=line_quantities * line_prices, minlength=order_count)
+    order_dates = np.datetime64('2024-01-01T00:00:00') + rng.integers(0, 365 * 86400, order_count).astype('timedelta64[s]')
+    analytics = store.SalesAnalytics([f"user{i}" for i in range(users)], order_dates, rng.integers(0, users, order_count),
+                                     order_totals, line_orders, line_products, line_quantities, line_prices)
+    print(f"{line_count} order lines, {order_count} orders")
+    queries = {
+        "total revenue": analytics.total_revenue,
+        "revenue by product (top 10)": lambda: analytics.revenue_by_product(10),
+        "units by product (top 10)": lambda: analytics.units_by_product(10),
+        "revenue by user (top 10)": lambda: analytics.revenue_by_user(10),
+        "revenue by day": analytics.revenue_by_day,
+        "basket sizes": analytics.basket_sizes,
+    }
+    for name, query in queries.items():
+        start = time.perf_counter()
+        query()
+        print(f"  {name:<28} {time.perf_counter() - start:.3f} s")
+
+
+#Load generator for the line-protocol server ("Final code.py" --serve). Each session signs up, logs in
+#and then cycles add, add, view cart, checkout; every round trip is timed.
+async def loadgen_session(host, port, index, requests, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+
+    async def call(line):
+        start = time.perf_counter()
+        writer.write((line + "\n").encode("utf-8"))
+        await writer.drain()
+        output = []
+        while True:
+            reply = await reader.readline()
+            if not reply or reply == b"END\n":
+                break
+            output.append(reply.decode("utf-8"))
+        latencies.append(time.perf_counter() - start)
+        return "".join(output)
+
+    username = f"load{index}_{os.getpid()}"
+    await call(f"SIGNUP {username} pw Load User Address {index}")
+    await call(f"LOGIN {username} pw")
+    product_ids = [int(line.split("|")[1]) for line in (await call("PRODUCTS")).splitlines() if line.startswith("| ") and line.split("|")[1].strip().isdigit()]
+    rng = random.Random(index)
+    for i in range(requests):
+        step = i % 4
+        if step < 2:
+            await call(f"ADD {rng.choice(product_ids)} {rng.randint(1, 3)}")
+        elif step == 2:
+            await call("CART")
+        else:
+            await call("CHECKOUT")
+    writer.write(b"QUIT\n")
+    await writer.drain()
+    writer.close()
+
+
+async def run_loadgen(host, port, sessions, requests):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(loadgen_session(host, port, i, requests, latencies) for i in range(sessions)))
+    return time.perf_counter() - start, sorted(latencies)
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def bench_loadgen(sessions, requests, host=None, port=None):
+    server = workdir = None
+    if port is None:
+        # No server given: start one on a free port over a scratch copy of the product data. Passwords are
+        # hashed at a token cost, as in the startup benchmark, so SIGNUP and LOGIN measure the server, not PBKDF2.
+        workdir = tempfile.mkdtemp()
+        shutil.copy(os.path.join(HERE, "product_data.txt"), workdir)
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            host, port = "127.0.0.1", probe.getsockname()[1]
+        server = subprocess.Popen([sys.executable, STORE_PATH, "--serve", "--host", host, "--port", str(port),
+                                   "--hash-iterations", "1000"],
+                                  cwd=workdir, stdout=subprocess.PIPE, text=True)
+        while "listening" not in server.stdout.readline():
+            if server.poll() is not None:
+                sys.exit("The store server failed to start.")
+    try:
+        elapsed, latencies = asyncio.run(run_loadgen(host, port, sessions, requests))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+    print(f"{sessions} sessions, {len(latencies)} requests in {elapsed:.2f} s")
+    print(f"  throughput  {len(latencies) / elapsed:,.0f} requests/s")
+    print(f"  latency p50 {percentile(latencies, 0.50) * 1000:.2f} ms")
+    print(f"  latency p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+
+
+#Builds a scratch store in "workdir": a catalog with limited stock and "carts" customers who each
+#have "history" past orders and a full cart, all compacted into User_data.dat.
+def build_flash_sale(store, workdir, carts, history):
+    os.chdir(workdir)
+    products = generate_products(store, 50)
+    for product in products:
+        product.stock = carts // 20
+    store.ProductCatalog(products).save_binary("product_data.bin")
+    with contextlib.redirect_stdout(io.StringIO()):
+        manager = store.AccountManager()
+        catalog = manager.products
+        for i in range(carts):
+            customer = store.Customer(f"buyer{i}", "pw", "Flash", "Buyer", "Address", store.ShoppingCart(catalog))
+            for j in range(history):
+                customer.history.append(store.OrderRecord("2024-07-08 18:36:23", [1 + (i + j) % 50], [1], 100.0, catalog))
+            for j in range(3):
+                customer.add_to_cart(catalog.get(1 + (i * 3 + j) % 50), 1)
+            manager.accounts[customer.username] = customer
+        manager.save_accounts()
+    return manager, [manager.accounts[f"buyer{i}"] for i in range(carts)]
+
+
+def bench_flash_sale(carts, history, batches):
+    store = load_store()
+    home = os.getcwd()
+    print(f"{carts} simultaneous checkouts, {history} past orders per customer")
+    modes = [("rewrite per order, no stock", None)] + [(f"pipeline, batch {size}", size) for size in batches]
+    try:
+        for name, batch in modes:
+            with tempfile.TemporaryDirectory() as workdir:
+                manager, customers = build_flash_sale(store, workdir, carts, history)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if batch is None:
+                        # What the menu did before the pipeline: checkout, then rewrite the account file. Storing the
+                        # customer again marks it changed; otherwise save_accounts() finds nothing to write.
+                        for customer in customers:
+                            customer.checkout()
+                            manager.accounts[customer.username] = customer
+                            manager.save_accounts()
+                        accepted = carts
+                    else:
+                        accepted = 0
+                        for i in range(0, carts, batch):
+                            accepted += sum(record is not None for record, message in manager.checkouts.process(customers[i:i + batch]))
+                elapsed = time.perf_counter() - start
+                manager.close()
+                os.chdir(home)
+            print(f"  {name:<24} {carts / elapsed:>10,.0f} checkouts/s   ({accepted} accepted)")
+    finally:
+        os.chdir(home)
+
+
+#Encode/decode throughput and record size of the old text account lines against the binary codec, for
+#customers with short and very long histories. "first order" is the time to the first order of a streamed history.
+def bench_codecs(users, histories):
+    store = load_store()
+    catalog = store.ProductCatalog(generate_products(store, 1000))
+    manager = store.AccountManager.__new__(store.AccountManager)
+    manager.products = catalog
+    codecs = {"text (legacy)": store.TextAccountCodec(manager), "binary": store.BinaryAccountCodec(catalog)}
+    print(f"{'orders':>7} | {'codec':<14} | {'encode/s':>10} | {'decode/s':>10} | {'first order (us)':>16} | {'bytes/user':>10}")
+    for history in histories:
+        with contextlib.redirect_stdout(io.StringIO()):
+            customers = list(generate_customers(store, catalog, 1000, users, history))
+        for name, codec in codecs.items():
+            start = time.perf_counter()
+            records = [codec.encode(customer) for customer in customers]
+            encode = time.perf_counter() - start
+            start = time.perf_counter()
+            for raw in records:
+                codec.decode(raw)
+            decode = time.perf_counter() - start
+            start = time.perf_counter()
+            for raw in records:
+                next(iter(codec.iter_history(raw)))
+            first = time.perf_counter() - start
+            size = sum(len(raw) for raw in records) / users
+            print(f"{history:>7} | {name:<14} | {users / encode:>10,.0f} | {users / decode:>10,.0f} | {first / users * 1e6:>16.1f} | {size:>10,.0f}")
+
+
+#Time to the first page of catalog searches on a freshly loaded catalog of "size" products, against
+#rendering the whole catalog the way view_products did before it was paged.
+def bench_search(size):
+    queries = ["", "laptop", "laptop accessory", "camera price:1000-5000", "watch sort:-price", "price:500-600 sort:price", "nosuchword"]
+    with tempfile.TemporaryDirectory() as workdir:
+        result = run_child(f"""
+from benchmark import generate_products
+start = time.perf_counter()
+store.ProductCatalog(generate_products(store, {size})).save_binary('product_data.bin')
+result['build'] = time.perf_counter() - start
+""", workdir)
+        print(f"{size} products (catalog file and term index written in {result['build']:.1f} s)")
+        result = run_child(f"""
+import io
+catalog = store.ProductCatalog()
+catalog.load_binary('product_data.bin')
+start = time.perf_counter()
+text = io.StringIO()
+for product in catalog:
+    print(product, file=text)
+result['full'] = time.perf_counter() - start
+times = []
+for text in {queries!r}:
+    catalog = store.ProductCatalog()
+    catalog.load_binary('product_data.bin')
+    query = store.ProductQuery.parse(text)
+    start = time.perf_counter()
+    store.render_product_page(catalog, 1, query)
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    store.render_product_page(catalog, 2, query)
+    times.append((first, time.perf_counter() - start))
+result['queries'] = times
+""", workdir)
+    print(f"  {'whole catalog (before)':<28} {result['full'] * 1000:>10.1f} ms")
+    print(f"  {'query':<28} {'page 1 (ms)':>10} {'page 2 (ms)':>12}")
+    for text, (first, second) in zip(queries, result['queries']):
+        print(f"  {repr(text):<28} {first * 1000:>10.2f} {second * 1000:>12.2f}")
+
+
+#One heavy customer with "orders" orders over ten years: login (decoding the account) and the windowed
+#history queries, against building every OrderRecord and printing the whole history as view_history did.
+def bench_history(orders):
+    store = load_store()
+    catalog = store.ProductCatalog(generate_products(store, 1000))
+    rng = random.Random(1)
+    customer = store.Customer("heavy", "pw", "Heavy", "Buyer", "Address", store.ShoppingCart(catalog))
+    start = time.mktime((2015, 1, 1, 0, 0, 0, 0, 0, -1))
+    for i in range(orders):
+        count = rng.randint(1, 5)
+        customer.history.append(store.OrderRecord(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start + i * 315360000 / orders)),
+                                                  rng.sample(range(1, 1001), count), [rng.randint(1, 3) for _ in range(count)],
+                                                  float(rng.randint(100, 200000)), catalog))
+    codec = store.BinaryAccountCodec(catalog)
+    raw = codec.encode(customer)
+    history = codec.decode(raw).history
+    cursor = history.page(None, 10)[1]
+    cases = [
+        ("every OrderRecord (before)", lambda: list(codec.iter_history(raw))),
+        ("print whole history (before)", lambda: codec.decode(raw).view_history(limit=orders)),
+        ("login (decode account)", lambda: codec.decode(raw)),
+        ("last 10 orders", lambda: history.last(10)),
+        ("one month (2020-06)", lambda: history.between("2020-06", "2020-06")),
+        ("next page by cursor", lambda: history.page(cursor, 10)),
+        ("lifetime spend and count", lambda: (history.spent, len(history))),
+        ("spend in 2020", lambda: history.spent_between("2020", "2020")),
+    ]
+    print(f"one customer, {orders} orders, {len(raw) / 1024:.0f} KB record")
+    for name, operation in cases:
+        best = None
+        for _ in range(3):
+            with contextlib.redirect_stdout(io.StringIO()):
+                began = time.perf_counter()
+                operation()
+                elapsed = time.perf_counter() - began
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"  {name:<30} {best * 1000:>10.3f} ms")
+
+
+#Cold logins per second through an AccountWorkerPool with more and more worker processes over the same
+#sharded store. Each pool starts with empty caches, so every login decodes its account from a shard file.
+#Passwords are hashed at a token cost (see bench_logins for the hashing itself).
+def bench_shards(users, history, shards, workers_list, logins, batch=500, seed=1):
+    store = load_store()
+    store.credentials.iterations = 1000
+    home = os.getcwd()
+    workdir = tempfile.mkdtemp()
+    try:
+        generate_store(store, workdir, 1000, users, history, seed, store.credentials.hash("pw"))
+        os.chdir(workdir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            store.AccountManager(shards=shards).close()
+        rng = random.Random(seed)
+        requests = [(f"user{rng.randrange(users)}", "pw") for _ in range(logins)]
+        print(f"{users} accounts in {shards} shards, {logins} logins in batches of {batch}, {os.cpu_count()} CPU cores")
+        baseline = None
+        for workers in workers_list:
+            pool = store.AccountWorkerPool(workers=workers)
+            try:
+                began = time.perf_counter()
+                for start in range(0, logins, batch):
+                    results = pool.map("authenticate", requests[start:start + batch])
+                    assert all(results)
+                elapsed = time.perf_counter() - began
+            finally:
+                pool.close()
+            rate = logins / elapsed
+            baseline = baseline or rate
+            print(f"  {pool.workers:>2} worker(s) {rate:>10.0f} logins/s  {rate / baseline:>5.2f}x")
+    finally:
+        os.chdir(home)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+#Cost of the instrumentation: the same hot paths with metrics off (the default), on, and on with the
+#sampling profiler running.
+def bench_metrics(users, history=20, products=1000, seed=1):
+    store = load_store()
+    store.credentials.iterations = 1000
+    home = os.getcwd()
+    workdir = tempfile.mkdtemp()
+    try:
+        generate_store(store, workdir, products, users, history, seed, store.credentials.hash("pw"))
+        os.chdir(workdir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager = store.AccountManager()
+        catalog = manager.products
+        customer = manager.accounts["user0"]
+
+        def login_cold(i):
+            username = f"user{i % users}"
+            manager.accounts.shard(username).cache.clear()
+            manager.authenticate(username, "pw")
+
+        cases = {
+            "product_lookup": (lambda i: catalog.get(i % products + 1), 200000),
+            "calculate_total": (lambda i: customer.cart.calculate_total(), 100000),
+            "login_cold": (login_cold, 2000),
+        }
+        modes = [("off", lambda: None, lambda: None), ("on", store.metrics.enable, store.metrics.disable),
+                 ("on + profiler", lambda: (store.metrics.enable(), store.metrics.start_profiler()),
+                  lambda: (store.metrics.stop_profiler(), store.metrics.disable()))]
+        print(f"{'case':<18}" + "".join(f"{name:>16}" for name, start, stop in modes) + "   (ops/sec)")
+        for case, (operation, repeat) in cases.items():
+            rates = []
+            for name, start, stop in modes:
+                start()
+                try:
+                    rates.append(measure(operation, repeat, 1)["ops_per_sec"])
+                finally:
+                    stop()
+            print(f"{case:<18}" + "".join(f"{rate:>16,.0f}" for rate in rates))
+        manager.close()
+    finally:
+        os.chdir(home)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+#Starts the interactive store in a new interpreter and returns the seconds until the first menu prompt
+#and, if "username" is given, from sending the login to "Login successful". Then exits through the menus.
+def time_to_prompt(workdir, options, username=None, password="pw"):
+    began = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-u", STORE_PATH, *options], cwd=workdir,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    output = b""
+
+    def wait_for(text):
+        nonlocal output
+        while text not in output:
+            chunk = os.read(process.stdout.fileno(), 65536)
+            if not chunk:
+                raise RuntimeError(f"store exited before printing {text!r}")
+            output += chunk
+        output = output[output.index(text) + len(text):]
+
+    try:
+        wait_for(b"Enter your choice: ")
+        first_prompt = time.perf_counter() - began
+        login = None
+        if username is not None:
+            sent = time.perf_counter()
+            process.stdin.write(f"2\n2\n{username}\n{password}\n".encode())
+            process.stdin.flush()
+            wait_for(b"Login successful")
+            login = time.perf_counter() - sent
+            process.stdin.write(b"8\n3\n")   # Logout, then back to the main menu
+        process.stdin.write(b"3\n")
+        process.stdin.close()
+        process.stdout.read()
+        process.wait()
+    finally:
+        if process.poll() is None:
+            process.kill()
+    return first_prompt, login
+
+
+#Time to the first menu prompt for a large store, loading it normally and from a startup snapshot
+#(--snapshot). The first run of each mode builds the account index or writes the snapshot and is not counted.
+#Passwords are hashed at a token cost so the login time is the account lookup, not the hashing.
+def bench_startup(products, users, runs, history=5, seed=1):
+    store = load_store()
+    store.credentials.iterations = 1000
+    workdir = tempfile.mkdtemp()
+    try:
+        generate_store(store, workdir, products, users, history, seed, store.credentials.hash("pw"))
+        print(f"{products} products, {users} accounts; best of {runs} runs")
+        for label, options in (("without snapshot", []), ("with snapshot", ["--snapshot"])):
+            options += ["--hash-iterations", "1000"]
+            time_to_prompt(workdir, options, "user0")
+            timings = [time_to_prompt(workdir, options, "user0") for _ in range(runs)]
+            print(f"  {label:<18} first prompt {min(first for first, login in timings) * 1000:>8.1f} ms"
+                  f"   first login {min(login for first, login in timings) * 1000:>7.2f} ms")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+#Password checks per second (and per core) at several hash costs as the credential thread pool grows,
+#then the cheap paths: a repeated login served from the verified cache, a session token, and a refused
+#login of a rate-limited user.
+def bench_logins(iterations_list, workers_list, logins, users=8):
+    store = load_store()
+    cores = os.cpu_count() or 1
+    print(f"{cores} CPU cores, {logins} logins per run over {users} users")
+    for iterations in iterations_list:
+        stored = [store.Credentials(iterations).hash("pw") for _ in range(users)]
+        for workers in workers_list:
+            credentials = store.Credentials(iterations, workers, session_ttl=0)
+            credentials.verify("warmup", stored[0], "pw")
+            began = time.perf_counter()
+            futures = [credentials.submit(f"user{i % users}", stored[i % users], "pw") for i in range(logins)]
+            assert all(future.result() for future in futures)
+            rate = logins / (time.perf_counter() - began)
+            print(f"  {iterations:>7} iterations  {workers:>2} worker(s) {rate:>9.1f} logins/s  {rate / min(workers, cores):>9.1f} per core")
+    credentials = store.Credentials(iterations_list[0], max_failures=1)
+    stored = credentials.hash("pw")
+    credentials.verify("user0", stored, "pw")
+    token = credentials.issue("user0")
+    credentials.verify("user1", stored, "wrong")
+
+    def refused():
+        try:
+            credentials.verify("user1", stored, "pw")
+        except store.ShoppingCartException:
+            pass
+
+    for name, operation in (("repeat login (verified cache)", lambda: credentials.verify("user0", stored, "pw")),
+                            ("session token", lambda: credentials.resume(token)),
+                            ("rate-limited login refused", refused)):
+        began = time.perf_counter()
+        for _ in range(20000):
+            operation()
+        print(f"  {name:<32} {20000 / (time.perf_counter() - began):>12,.0f} /s")
+
+
+#A random promotion set over "products" products: percentages on single products and categories,
+#buy-x-get-y offers and coupons, with categories given by product ids.
+def generate_rules(products, count, seed=1):
+    rng = random.Random(seed)
+    categories = {f"category{i}": {"ids": rng.sample(range(1, products + 1), 50)} for i in range(20)}
+    rules = []
+    for i in range(count):
+        kind = ("percent", "category", "buy_x_get_y", "coupon")[i % 4]
+        if kind == "percent":
+            rules.append({"type": kind, "percent": rng.randint(5, 50), "products": rng.sample(range(1, products + 1), 5)})
+        elif kind == "category":
+            rules.append({"type": kind, "category": rng.choice(list(categories)), "percent": rng.randint(5, 30)})
+        elif kind == "buy_x_get_y":
+            rules.append({"type": kind, "product": rng.randint(1, products), "buy": rng.randint(1, 3), "get": 1})
+        else:
+            rules.append({"type": kind, "code": f"CODE{i}", "percent": rng.randint(5, 20)})
+    return rules, categories
+
+
+#The rules walked for every line on every call, as an uncompiled engine would.
+def interpreted_total(cart, rules, categories, code):
+    total = 0
+    for line in cart.items.values():
+        product, quantity = line.product, line.quantity
+        percent, offer = 0, None
+        for rule in rules:
+            if rule["type"] == "percent" and (rule.get("products") is None or product.id in rule["products"]):
+                percent = max(percent, rule["percent"])
+            elif rule["type"] == "category" and product.id in categories[rule["category"]]["ids"]:
+                percent = max(percent, rule["percent"])
+            elif rule["type"] == "buy_x_get_y" and rule["product"] == product.id:
+                offer = rule
+        if offer is not None:
+            quantity -= quantity // (offer["buy"] + offer["get"]) * offer["get"]
+        total += product.price * quantity * (1 - percent / 100)
+    for rule in rules:
+        if rule["type"] == "coupon" and rule["code"] == code:
+            total *= 1 - rule["percent"] / 100
+    return total
+
+
+#Cart totals under a promotion set: interpreting the rules per call, the compiled engine recomputing
+#every line, and the memoized total, plus what add/remove and rule or price changes cost it.
+def bench_pricing(line_counts, rule_count, products=10000):
+    store = load_store()
+    catalog = store.ProductCatalog(generate_products(store, products))
+    rules, categories = generate_rules(products, rule_count)
+    catalog.pricing.set_rules(rules, categories)
+    engine = catalog.pricing
+    print(f"{rule_count} rules, {len(engine.lines)} discounted products")
+    for line_count in line_counts:
+        cart = store.ShoppingCart(catalog)
+        ids = random.Random(2).sample(range(1, products + 1), line_count)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for product_id in ids:
+                cart.add_product(catalog.get(product_id), 3)
+            cart.apply_coupon("CODE3")
+        cart.calculate_total()
+        in_cart, outside = catalog.get(ids[0]), next(product_id for product_id in range(1, products + 1) if product_id not in cart.items)
+
+        def add_remove(i):
+            cart.add_product(in_cart, 1)
+            cart.remove_product(in_cart, 1)
+            cart.calculate_total()
+
+        def unrelated_rule(i):
+            engine.set_rules(rules + [{"type": "percent", "percent": 1 + i % 50, "products": [outside]}], categories)
+            cart.calculate_total()
+
+        def price_change(i):
+            engine.reprice(in_cart, 100 + i % 1000)
+            cart.calculate_total()
+
+        cases = [
+            ("interpreted rules (before)", lambda i: interpreted_total(cart, rules, categories, "CODE3")),
+            ("compiled, every line", lambda i: engine.apply_coupon(sum(engine.line_total(line.product, line.quantity) for line in cart.items.values()), "CODE3")),
+            ("memoized total", lambda i: cart.calculate_total()),
+            ("add + remove + total", add_remove),
+            ("unrelated rule change + total", unrelated_rule),
+            ("price change in cart + total", price_change),
+        ]
+        print(f"  cart of {line_count} lines")
+        for name, operation in cases:
+            repeat = 2000 if name.startswith(("memoized", "add")) else max(20, 20000 // line_count // (10 if name.startswith("interpreted") else 1))
+            result = measure(operation, repeat)
+            print(f"    {name:<32} {result['ops_per_sec']:>14,.0f} ops/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the online shopping cart.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    suite = commands.add_parser("suite", help="hot-path suite with JSON results and baseline comparison")
+    suite.add_argument("--products", type=int, default=1000)
+    suite.add_argument("--users", type=int, default=2000)
+    suite.add_argument("--history", type=int, default=20)
+    suite.add_argument("--output", default="benchmark_results.json")
+    suite.add_argument("--baseline", help="compare against a previously saved results file")
+    suite.add_argument("--save-baseline", help="also write the results to this file for later comparisons")
+    suite.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput drop before a case counts as a regression")
+    catalog = commands.add_parser("catalog", help="product catalog load time and peak RSS: eval() vs binary")
+    catalog.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    memory = commands.add_parser("memory", help="bytes per order, user and product before and after the slotted representation")
+    memory.add_argument("--count", type=int, default=100000)
+    memory.add_argument("--lines", type=int, default=3)
+    analytics = commands.add_parser("analytics", help="time the vectorized sales queries over synthetic order lines")
+    analytics.add_argument("--lines", type=int, default=10000000)
+    loadgen = commands.add_parser("loadgen", help="concurrent sessions against the store server: throughput and p50/p99 latency")
+    loadgen.add_argument("--sessions", type=int, default=50)
+    loadgen.add_argument("--requests", type=int, default=200)
+    loadgen.add_argument("--host", default="127.0.0.1")
+    loadgen.add_argument("--port", type=int, help="existing server to target; by default a scratch server is started")
+    flash = commands.add_parser("flashsale", help="checkout throughput: full rewrite per order vs the batched pipeline")
+    flash.add_argument("--carts", type=int, default=2000)
+    flash.add_argument("--history", type=int, default=20)
+    flash.add_argument("--batches", type=int, nargs="+", default=[1, 16, 256])
+    codecs = commands.add_parser("codecs", help="account encode/decode speed and size: legacy text lines vs the binary codec")
+    codecs.add_argument("--users", type=int, default=200)
+    codecs.add_argument("--history", type=int, nargs="+", default=[20, 2000])
+    search = commands.add_parser("search", help="first-page latency of paged catalog searches against rendering the whole catalog")
+    search.add_argument("--size", type=int, default=1000000)
+    history = commands.add_parser("history", help="login and windowed history queries for one customer with a very long history")
+    history.add_argument("--orders", type=int, default=100000)
+    shards = commands.add_parser("shards", help="cold logins/sec through the shard worker pool as workers are added")
+    shards.add_argument("--users", type=int, default=20000)
+    shards.add_argument("--history", type=int, default=20)
+    shards.add_argument("--shards", type=int, default=8)
+    shards.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    shards.add_argument("--logins", type=int, default=20000)
+    metrics = commands.add_parser("metrics", help="overhead of the instrumentation: metrics off, on, and with the profiler")
+    metrics.add_argument("--users", type=int, default=2000)
+    startup = commands.add_parser("startup", help="time to the first menu prompt for a large store, with and without the startup snapshot")
+    startup.add_argument("--products", type=int, default=1000000)
+    startup.add_argument("--users", type=int, default=100000)
+    startup.add_argument("--runs", type=int, default=3)
+    logins = commands.add_parser("logins", help="hashed password checks per second and per core, and the cached and rate-limited paths")
+    logins.add_argument("--iterations", type=int, nargs="+", default=[100000, 200000, 600000])
+    logins.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    logins.add_argument("--logins", type=int, default=24)
+    pricing = commands.add_parser("pricing", help="cart totals under a promotion set: interpreted rules vs compiled vs memoized")
+    pricing.add_argument("--lines", type=int, nargs="+", default=[10, 100, 1000])
+    pricing.add_argument("--rules", type=int, default=200)
+    args = parser.parse_args()
+    if args.command == "suite":
+        bench_suite(args.products, args.users, args.history, args.output, args.baseline, args.save_baseline, args.tolerance)
+    elif args.command == "catalog":
+        bench_catalog(args.sizes)
+    elif args.command == "memory":
+        bench_memory(args.count, args.lines)
+    elif args.command == "analytics":
+        bench_analytics(args.lines)
+    elif args.command == "loadgen":
+        bench_loadgen(args.sessions, args.requests, args.host, args.port)
+    elif args.command == "flashsale":
+        bench_flash_sale(args.carts, args.history, args.batches)
+    elif args.command == "codecs":
+        bench_codecs(args.users, args.history)
+    elif args.command == "search":
+        bench_search(args.size)
+    elif args.command == "history":
+        bench_history(args.orders)
+    elif args.command == "shards":
+        bench_shards(args.users, args.history, args.shards, args.workers, args.logins)
+    elif args.command == "metrics":
+        bench_metrics(args.users)
+    elif args.command == "startup":
+        bench_startup(args.products, args.users, args.runs)
+    elif args.command == "logins":
+        bench_logins(args.iterations, args.workers, args.logins)
+    elif args.command == "pricing":
+        bench_pricing(args.lines, args.rules)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import asyncio
+import contextlib
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_store():
+    spec = importlib.util.spec_from_file_location("store", os.path.join(ROOT, "Final code.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+#Drives a StoreServer session with the seed data copied into a scratch directory.
+class SessionTokenTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.scratch = tempfile.mkdtemp()
+        for name in ("User_data.txt", "product_data.txt"):
+            shutil.copy(os.path.join(ROOT, name), self.scratch)
+        os.chdir(self.scratch)
+        self.store = load_store()
+        self.store.credentials.iterations = 1000
+        self.manager = self.store.AccountManager()
+        self.server = self.store.StoreServer(self.manager)
+
+    def tearDown(self):
+        self.manager.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.scratch)
+
+    #Sends one command the way serve() does, with printed output captured per session.
+    def run_command(self, session, command, args=""):
+        with contextlib.redirect_stdout(self.server.output):
+            return asyncio.run(self.server.run(session, command, args))
+
+    def test_token_fails_after_logout(self):
+        session = {"username": None, "admin": None, "token": None}
+        output = self.run_command(session, "LOGIN", "w w")
+        token = output.split("Session token: ")[1].split()[0]
+        self.run_command(session, "LOGOUT")
+        self.assertIsNone(session["username"])
+
+        other = {"username": None, "admin": None, "token": None}
+        output = self.run_command(other, "TOKEN", token)
+        self.assertIn("Invalid or expired session token", output)
+        self.assertIsNone(other["username"])
+
+    def test_token_resumes_before_logout(self):
+        session = {"username": None, "admin": None, "token": None}
+        output = self.run_command(session, "LOGIN", "w w")
+        token = output.split("Session token: ")[1].split()[0]
+
+        other = {"username": None, "admin": None, "token": None}
+        output = self.run_command(other, "TOKEN", token)
+        self.assertIn("Login successful as w.", output)
+        self.assertEqual(other["username"], "w")
+
+
+if __name__ == "__main__":
+    unittest.main()